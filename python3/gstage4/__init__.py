@@ -44,6 +44,27 @@ from ._prototype import ScriptInChroot
 from ._workdir import WorkDir
 
 from ._runner import Runner
+from ._runner import AsyncRunner
+
+from ._cgroup import CGroup
+
+from ._accounting import ResourceAccounting
+from ._accounting import CommandRecord
+
+from ._profiler import Profiler
+from ._profiler import ProfileSpan
+
+from ._emergelog import EmergeEvent
+from ._emergelog import EmergeLogWatcher
+
+from ._buildtimedb import BuildTimeDatabase
+
+from ._distfiles import DistfilePrefetcher
+
+from ._binhost import BinhostServer
+
+from ._pressure import PressureController
+from ._pressure import BuildUsageMonitor
 
 from ._builder import Builder
 from ._builder import BuildStep
@@ -51,3 +72,5 @@ from ._builder import BuildStep
 from ._errors import SettingsError
 from ._errors import SeedStageError
 from ._errors import WorkDirError
+from ._errors import RepositoryError
+from ._errors import SyncError
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import time
+import threading
+import contextlib
+import contextvars
+from ._profiler import Profiler
+
+
+class CommandRecord:
+
+    """Resource usage of one finished command"""
+
+    def __init__(self, cmd, step, description, thread_id, start_time, wall_time, user_time, system_time, max_rss, block_input, block_output, returncode):
+        self.cmd = cmd                          # command line, str or list
+        self.step = step                        # builder action, or None
+        self.description = description         # description of ScriptInChroot or other task, or None
+        self.thread_id = thread_id              # see Profiler.get_thread_id()
+        self.start_time = start_time            # seconds since epoch
+        self.wall_time = wall_time              # seconds
+        self.user_time = user_time              # seconds, None if not available
+        self.system_time = system_time          # seconds, None if not available
+        self.max_rss = max_rss                  # bytes, of the largest process in the process tree, None if not available
+        self.block_input = block_input          # number of block input operations, None if not available
+        self.block_output = block_output        # number of block output operations, None if not available
+        self.returncode = returncode
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class ResourceAccounting:
+
+    """
+    Collects a CommandRecord for every command executed by Util and Runner while it is activated.
+    Activation is bound to the current context (see contextvars), so that builds running in different threads are kept apart.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = []
+
+    @contextlib.contextmanager
+    def activate(self, step=None):
+        token = _state.set(_State(self, step, None))
+        try:
+            yield self
+        finally:
+            _state.reset(token)
+
+    def get_records(self):
+        with self._lock:
+            return list(self._records)
+
+    def clear(self):
+        with self._lock:
+            self._records = []
+
+    @staticmethod
+    @contextlib.contextmanager
+    def describe(description):
+        # commands executed in this context belong to the specified task
+        s = _state.get()
+        if s is None:
+            yield
+            return
+
+        token = _state.set(_State(s.accounting, s.step, description))
+        try:
+            yield
+        finally:
+            _state.reset(token)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def suppress():
+        # commands executed in this context are not recorded, the caller records them in its own way
+        token = _state.set(None)
+        try:
+            yield
+        finally:
+            _state.reset(token)
+
+    @staticmethod
+    def record(cmd, start_time, wall_time, rusage, returncode):
+        # rusage is the value returned by os.wait4(), or a (user_time, system_time) tuple, or None
+        s = _state.get()
+        if s is None:
+            return
+
+        if rusage is None:
+            userTime, systemTime, maxRss, blockInput, blockOutput = None, None, None, None, None
+        elif hasattr(rusage, "ru_utime"):
+            # ru_maxrss is in kilobytes on linux
+            userTime, systemTime, maxRss, blockInput, blockOutput = rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss * 1024, rusage.ru_inblock, rusage.ru_oublock
+        else:
+            userTime, systemTime, maxRss, blockInput, blockOutput = rusage[0], rusage[1], None, None, None
+
+        r = CommandRecord(cmd, s.step, s.description, Profiler.get_thread_id(), start_time, wall_time, userTime, systemTime, maxRss, blockInput, blockOutput, returncode)
+        with s.accounting._lock:
+            s.accounting._records.append(r)
+
+
+class CommandTimer:
+
+    """Measures wall time of a command, and records it when the command finishes"""
+
+    def __init__(self, cmd):
+        self._cmd = cmd
+        self._startTime = time.time()
+        self._startTm = time.monotonic()
+
+    def finish(self, returncode, rusage=None):
+        ResourceAccounting.record(self._cmd, self._startTime, time.monotonic() - self._startTm, rusage, returncode)
+
+
+class _State:
+
+    def __init__(self, accounting, step, description):
+        self.accounting = accounting
+        self.step = step
+        self.description = description
+
+
+_state = contextvars.ContextVar("gstage4_resource_accounting", default=None)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import stat
+import time
+import fcntl
+import struct
+import hashlib
+import threading
+import contextlib
+import http.server
+import urllib.parse
+import functools
+
+
+class BinhostServer:
+
+    """
+    Serves binary package directories over HTTP, so that they can be used by other builders through PORTAGE_BINHOST.
+    Any directory under root_dir which contains binary packages can be used as a binhost, such as the partitions of
+    Settings.host_packages_dir. Its "Packages" index is regenerated from the xpak metadata of the packages when it is
+    requested and the packages have changed. Packages being written by concurrent builders are not seen, since portage
+    holds the lock of "Packages" when it adds packages.
+    """
+
+    _INDEX_KEYS = [
+        "BDEPEND", "BUILD_ID", "BUILD_TIME", "DEFINED_PHASES", "DEPEND", "EAPI", "IDEPEND", "IUSE", "KEYWORDS",
+        "LICENSE", "PDEPEND", "PROVIDES", "RDEPEND", "REQUIRES", "RESTRICT", "SLOT",
+    ]
+
+    def __init__(self, root_dir, address="127.0.0.1", port=0):
+        self._rootDir = os.path.abspath(root_dir)
+        self._address = address
+        self._port = port
+        self._server = None
+        self._thread = None
+
+        self._lock = threading.Lock()       # protects self._dirDict only
+        self._dirDict = dict()              # dict<dir, _PackageDir>
+
+    @property
+    def url(self):
+        assert self._server is not None
+        return "http://%s:%d" % (self._address, self._server.server_address[1])
+
+    def start(self):
+        assert self._server is None
+
+        handler = functools.partial(_RequestHandler, self, directory=self._rootDir)
+        self._server = http.server.ThreadingHTTPServer((self._address, self._port), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def get_index(self, pkgdir):
+        # returns content of the Packages index of pkgdir, pkgdir is relative to root_dir
+        dirpath = os.path.normpath(os.path.join(self._rootDir, pkgdir))
+        assert dirpath == self._rootDir or dirpath.startswith(self._rootDir + "/")
+
+        # requests for different directories are served concurrently, the ones for the same directory wait for one rebuild
+        with self._lock:
+            if dirpath not in self._dirDict:
+                self._dirDict[dirpath] = _PackageDir()
+            pd = self._dirDict[dirpath]
+
+        with pd.lock:
+            with self._portageLock(dirpath):
+                signature = self._scanPackages(dirpath)
+                if pd.signature == signature:
+                    return pd.content
+
+                entryList = []
+                for path, size, mtime in signature:
+                    entry = self._getEntry(pd, dirpath, path, size, mtime)
+                    if entry is not None:
+                        entryList.append(entry)
+
+                # forget the packages which are removed or replaced
+                keySet = set(signature)
+                pd.entryCache = {k: v for k, v in pd.entryCache.items() if k in keySet}
+
+            # portage caches the index of a binhost until its TIMESTAMP changes
+            timestamp = int(time.time())
+            if pd.timestamp is not None:
+                timestamp = max(timestamp, pd.timestamp + 1)
+
+            buf = ""
+            buf += "PACKAGES: %d\n" % (len(entryList))
+            buf += "TIMESTAMP: %d\n" % (timestamp)
+            buf += "VERSION: 0\n"
+            buf += "\n"
+            for entry in sorted(entryList, key=lambda x: (x["CPV"], x["PATH"])):
+                for k in sorted(entry):
+                    if entry[k] != "":
+                        buf += "%s: %s\n" % (k, entry[k])
+                buf += "\n"
+
+            pd.signature, pd.timestamp, pd.content = signature, timestamp, buf
+            return buf
+
+    def _scanPackages(self, dirpath):
+        # returns list<(relative-path, size, mtime-ns)> of "<category>/<pf>.tbz2" and "<category>/<pn>/<pf>-<build-id>.xpak"
+        # packages may be removed by others (such as eclean) without the lock, the removed ones are skipped
+        def __listdir(path):
+            try:
+                return sorted(os.listdir(path))
+            except (FileNotFoundError, NotADirectoryError):
+                return []
+
+        pathList = []
+        for category in __listdir(dirpath):
+            cdir = os.path.join(dirpath, category)
+            if category.startswith("."):
+                continue
+            for fn in __listdir(cdir):
+                if fn.endswith(".tbz2"):
+                    pathList.append(os.path.join(category, fn))
+                else:
+                    for fn2 in __listdir(os.path.join(cdir, fn)):
+                        if fn2.endswith(".xpak"):
+                            pathList.append(os.path.join(category, fn, fn2))
+
+        ret = []
+        for path in pathList:
+            try:
+                st = os.stat(os.path.join(dirpath, path))
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                ret.append((path, st.st_size, st.st_mtime_ns))
+        return ret
+
+    def _getEntry(self, pd, dirpath, path, size, mtime):
+        # returns dict<key, value> of a package in the Packages index, None if it is not a valid binary package
+        key = (path, size, mtime)
+        if key not in pd.entryCache:
+            fullfn = os.path.join(dirpath, path)
+            try:
+                metadata = _readXpak(fullfn)
+            except (OSError, ValueError):
+                return None
+            if metadata.get("CATEGORY", "") != path.split("/")[0] or "PF" not in metadata:
+                return None
+
+            md5 = hashlib.md5()
+            sha1 = hashlib.sha1()
+            try:
+                with open(fullfn, "rb") as f:
+                    while True:
+                        buf = f.read(1024 * 1024)
+                        if len(buf) == 0:
+                            break
+                        md5.update(buf)
+                        sha1.update(buf)
+            except FileNotFoundError:
+                return None
+
+            # only flags in IUSE are recorded in USE, as portage does
+            iuse = set([x.lstrip("+-") for x in metadata.get("IUSE", "").split()])
+
+            entry = {k: " ".join(metadata.get(k, "").split()) for k in self._INDEX_KEYS}
+            entry["CPV"] = "%s/%s" % (metadata["CATEGORY"], metadata["PF"])
+            entry["USE"] = " ".join(sorted([x for x in metadata.get("USE", "").split() if x in iuse]))
+            entry["REPO"] = metadata.get("repository", "")
+            entry["PATH"] = path
+            entry["SIZE"] = str(size)
+            entry["MTIME"] = str(mtime // 1000000000)
+            entry["MD5"] = md5.hexdigest()
+            entry["SHA1"] = sha1.hexdigest()
+            pd.entryCache[key] = entry
+        return pd.entryCache[key]
+
+    @contextlib.contextmanager
+    def _portageLock(self, dirpath):
+        # the same lock portage uses when it updates the Packages index, it is a fcntl() record lock
+        # portage deletes the lock file when releasing it, so we retry if the file is deleted or replaced while we are
+        # waiting for the lock, as portage.locks does
+        path = os.path.join(dirpath, ".Packages.portage_lockfile")
+        while True:
+            f = open(path, "a+")
+            try:
+                fcntl.lockf(f, fcntl.LOCK_SH)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    st = None
+                if st is not None and (st.st_dev, st.st_ino) == (os.fstat(f.fileno()).st_dev, os.fstat(f.fileno()).st_ino):
+                    break
+            except BaseException:
+                f.close()
+                raise
+            f.close()
+
+        try:
+            yield
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+            f.close()
+
+
+class _PackageDir:
+
+    """Index state of a binary package directory, all the fields are protected by lock"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.signature = None               # list<(relative-path, size, mtime-ns)> of the packages
+        self.timestamp = None
+        self.content = None                 # content of Packages index
+        self.entryCache = dict()            # dict<(relative-path, size, mtime-ns), dict<key, value>>
+
+
+class _RequestHandler(http.server.SimpleHTTPRequestHandler):
+
+    def __init__(self, binhostServer, *kargs, **kwargs):
+        self._binhostServer = binhostServer
+        super().__init__(*kargs, **kwargs)
+
+    def do_GET(self):
+        self._serve(True)
+
+    def do_HEAD(self):
+        self._serve(False)
+
+    def _serve(self, withBody):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        if os.path.basename(path) != "Packages":
+            if withBody:
+                super().do_GET()
+            else:
+                super().do_HEAD()
+            return
+
+        pkgdir = os.path.normpath(os.path.dirname(path)).lstrip("/")
+        if pkgdir.startswith("..") or not os.path.isdir(os.path.join(self.directory, pkgdir)):
+            self.send_error(404)
+            return
+
+        buf = self._binhostServer.get_index(pkgdir).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(buf)))
+        self.end_headers()
+        if withBody:
+            self.wfile.write(buf)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _readXpak(path):
+    # returns dict<key, value> of the xpak metadata in a .tbz2 or .xpak file
+    # layout: ... "XPAKPACK" index-len data-len index data "XPAKSTOP" xpak-len "STOP"
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        fileSize = f.tell()
+        if fileSize < 16:
+            raise ValueError("file too small")
+        f.seek(-8, os.SEEK_END)
+        xpakLen, stop = struct.unpack(">I4s", f.read(8))
+        if stop != b"STOP" or xpakLen + 8 > fileSize:
+            raise ValueError("no xpak segment")
+        f.seek(-8 - xpakLen, os.SEEK_END)
+        buf = f.read(xpakLen)
+
+    if not buf.startswith(b"XPAKPACK") or not buf.endswith(b"XPAKSTOP"):
+        raise ValueError("invalid xpak segment")
+    indexLen, dataLen = struct.unpack(">II", buf[8:16])
+    index = buf[16:16 + indexLen]
+    data = buf[16 + indexLen:16 + indexLen + dataLen]
+
+    ret = dict()
+    i = 0
+    while i < len(index):
+        nameLen = struct.unpack(">I", index[i:i + 4])[0]
+        name = index[i + 4:i + 4 + nameLen].decode("utf-8", errors="replace")
+        offset, length = struct.unpack(">II", index[i + 4 + nameLen:i + 12 + nameLen])
+        ret[name] = data[offset:offset + length].decode("utf-8", errors="replace").rstrip("\n")
+        i += 12 + nameLen
+    return ret
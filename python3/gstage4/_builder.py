@@ -24,10 +24,23 @@
 import os
 import re
 import json
+import stat
 import enum
+import time
+import uuid
+import glob
+import shlex
+import shutil
 import pathlib
+import threading
+import traceback
+import subprocess
+import contextlib
 import robust_layer.simple_fops
 from ._util import Util
+from ._util import MS_BIND
+from ._util import MS_REMOUNT
+from ._util import MS_RDONLY
 from ._prototype import SeedStage
 from ._prototype import ManualSyncRepository
 from ._prototype import MountRepository
@@ -37,6 +50,16 @@ from ._errors import SettingsError
 from ._settings import Settings
 from ._settings import TargetSettings
 from ._runner import Runner
+from ._cgroup import CGroup
+from ._sync import RepositorySyncer
+from ._accounting import ResourceAccounting
+from ._profiler import Profiler
+from ._emergelog import EmergeEvent
+from ._emergelog import EmergeLogWatcher
+from ._buildtimedb import BuildTimeDatabase
+from ._distfiles import DistfilePrefetcher
+from ._pressure import PressureController
+from ._pressure import BuildUsageMonitor
 from .scripts import ScriptFromBuffer
 
 
@@ -46,10 +69,20 @@ def Action(*progressStepTuple):
             progressStepList = list(progressStepTuple)
             assert sorted(progressStepList) == list(progressStepList)
             assert self._progress in progressStepList
-            self._workDirObj.open_chroot_dir(from_dir_name=self._getChrootDirName())
-            func(self, *kargs, **kwargs)
-            self._progress = BuildStep(progressStepList[-1] + 1)
-            self._workDirObj.close_chroot_dir(to_dir_name=self._getChrootDirName())
+            try:
+                with self._accounting.activate(step=func.__name__), self._profiler.activate():
+                    with Profiler.span(func.__name__, "step"):
+                        with Profiler.span("Copy chroot directory" if self._workDirObj.can_rollback else "Rename chroot directory", "workdir"):
+                            self._workDirObj.open_chroot_dir(from_dir_name=self._getChrootDirName())
+                        func(self, *kargs, **kwargs)
+                        if self._workDirObj.can_rollback:
+                            # chroot directory is copied when opened in rollback mode, so it can't carry mounts
+                            self._unbindSessionChrooter()
+                        self._progress = BuildStep(progressStepList[-1] + 1)
+                        with Profiler.span("Rename chroot directory", "workdir"):
+                            self._workDirObj.close_chroot_dir(to_dir_name=self._getChrootDirName())
+            finally:
+                self._writeProfile()
         return wrapper
     return decorator
 
@@ -85,9 +118,23 @@ class Builder:
         self._ts = target_settings
         if self._ts.build_opts.ccache and self._s.host_ccache_dir is None:
             raise SettingsError("ccache is enabled but host ccache directory is not specified")
+        if self._s.binpkg_reuse and self._s.host_packages_dir is None:
+            raise SettingsError("binary package reuse is enabled but host packages directory is not specified")
 
         self._workDirObj = work_dir
 
+        self._accounting = ResourceAccounting()
+        self._profiler = Profiler()
+        self._emergeCallbackList = []
+
+        self._buildTimeDb = BuildTimeDatabase(self._s.host_build_time_db) if self._s.host_build_time_db is not None else None
+        self._etaLock = threading.Lock()
+        self._etaDict = None                    # dict<cpv, estimated-seconds-or-None> of the packages being merged
+        self._etaJobs = None                    # number of emerge jobs merging them
+
+        self._sessionThreadId = None            # not None if in session mode, see open_session()
+        self._sessionChrooter = None
+
         self._progress = BuildStep.INIT
         self._workDirObj.open_chroot_dir()
         self._workDirObj.close_chroot_dir(to_dir_name=self._getChrootDirName())
@@ -95,6 +142,51 @@ class Builder:
     def get_progress(self):
         return self._progress
 
+    def get_command_records(self):
+        # returns list<CommandRecord> of all the commands executed by actions
+        return self._accounting.get_records()
+
+    def get_profile_spans(self):
+        # returns list<ProfileSpan> of the actions and their sub-phases
+        return self._profiler.get_spans()
+
+    def add_emerge_event_callback(self, callback):
+        # callback is called with EmergeEvent objects when packages are being installed, in a separate thread
+        self._emergeCallbackList.append(callback)
+
+    def get_eta(self):
+        # returns (estimated-remaining-seconds, number-of-packages-without-history) of updating @world, None if not available
+        # it is available only when host_build_time_db is specified
+        # packages are built by emerge jobs in parallel, but a package can't be finished earlier than its own build time
+        with self._etaLock:
+            if self._etaDict is None:
+                return None
+            estimates = list(self._etaDict.values())
+            jobs = self._etaJobs
+        known = [x for x in estimates if x is not None]
+        return (max(sum(known) / jobs, max(known, default=0)), len(estimates) - len(known))
+
+    def open_session(self):
+        # In session mode, the chroot environment is bound when it is first needed, and is kept bound across
+        # consecutive actions until close_session() is called. The mounts move with the chroot directory when it
+        # is renamed between actions. The mount namespace belongs to the calling thread, so all the actions in the
+        # session must be executed in this thread.
+        assert self._sessionThreadId is None
+        self._sessionThreadId = threading.get_ident()
+
+    def close_session(self):
+        assert self._sessionThreadId == threading.get_ident()
+        self._unbindSessionChrooter()
+        self._sessionThreadId = None
+
+    @contextlib.contextmanager
+    def session(self):
+        self.open_session()
+        try:
+            yield self
+        finally:
+            self.close_session()
+
     @Action(BuildStep.INIT)
     def action_unpack(self, seed_stage):
         assert isinstance(seed_stage, SeedStage)
@@ -121,7 +213,7 @@ class Builder:
         elif isinstance(repo, EmergeSyncRepository):
             myRepo = _MyRepoUtil.createFromEmergeSyncRepo(repo, True, self._workDirObj.chroot_dir_path)
             assert myRepo.get_sync_type() == "rsync"
-            with _MyChrooter(self) as m:
+            with self._chrooter() as m:
                 m.script_exec(ScriptSync(), quiet=self._getQuiet())
         elif isinstance(repo, MountRepository):
             _MyRepoUtil.createFromMountRepo(repo, True, self._workDirObj.chroot_dir_path)
@@ -131,7 +223,7 @@ class Builder:
     @Action(BuildStep.GENTOO_REPOSITORY_CREATED)
     def action_init_confdir(self):
         if self._ts.profile is not None:
-            with _MyChrooter(self) as m:
+            with self._chrooter() as m:
                 m.shell_call("", "eselect profile set %s" % (self._ts.profile))
 
         t = TargetConfDirWriter(self._s, self._ts, self._workDirObj.chroot_dir_path)
@@ -142,6 +234,7 @@ class Builder:
         t.write_package_accept_keywords()
         t.write_package_license()
         t.write_use_mask()
+        t.write_package_env()
 
     @Action(BuildStep.CONFDIR_INITIALIZED)
     def action_create_overlays(self, preprocess_script_list=[], overlay_list=[]):
@@ -172,20 +265,31 @@ class Builder:
             else:
                 assert False
 
+        # overlays are independent of each other, so they are synchronized concurrently
+        syncer = RepositorySyncer(self._s.network_jobs, quiet=self._getQuiet())
+        for overlay in overlay_list:
+            if isinstance(overlay, ManualSyncRepository):
+                syncer.add_task(overlay.get_name(), overlay.sync, os.path.join(self._workDirObj.chroot_dir_path, overlay.get_datadir_path()[1:]))
+
         if len(preprocess_script_list) > 0 or any([isinstance(repo, EmergeSyncRepository) for repo in overlay_list]):
-            with _MyChrooter(self) as m:
-                for s in preprocess_script_list:
-                    m.script_exec(s, quiet=self._getQuiet())
+            with self._chrooter() as m:
+                m.script_exec_batch(preprocess_script_list, quiet=self._getQuiet())
 
                 installList = [x for x in pkgSet if not Util.portageIsPkgInstalled(self._workDirObj.chroot_dir_path, x)]
-                m.script_exec(ScriptInstallPackages(installList, self._s.verbose_level), quiet=self._getQuiet())
-
-                if any([isinstance(repo, EmergeSyncRepository) for repo in overlay_list]):
-                    m.script_exec(ScriptSync(), quiet=self._getQuiet())
-
-        for overlay in overlay_list:
-            if isinstance(overlay, ManualSyncRepository):
-                overlay.sync(os.path.join(self._workDirObj.chroot_dir_path, overlay.get_datadir_path()[1:]))
+                if len(installList) > 0:
+                    with self._watchEmergeLog(m) as emergeLogDir:
+                        m.script_exec(ScriptInstallPackages(installList, self._s.verbose_level, emergeLogDir), quiet=self._getQuiet())
+
+                # "emerge --sync" would sync all the repositories one by one, including the gentoo repository
+                # environment is the same as ScriptSync
+                env = "EMERGE_WARNING_DELAY=0 CLEAN_DELAY=0 EBEEP_IGNORE=0 EPAUSE_IGNORE=0"
+                for overlay in overlay_list:
+                    if isinstance(overlay, EmergeSyncRepository):
+                        syncer.add_task(overlay.get_name(), m.shell_call, env, "emaint sync --repo %s" % (overlay.get_name()))
+
+                syncer.run()
+        else:
+            syncer.run()
 
         self._workDirObj.save_record("overlays", json.dumps(overlayRecord))
 
@@ -229,6 +333,9 @@ class Builder:
         if self._ts.build_opts.ccache:
             __pkgNeeded("dev-util/ccache")
 
+        if len(self._s.distcc_hosts) > 0:
+            __pkgNeeded("sys-devel/distcc")
+
         overlayRecord = json.loads(self._workDirObj.load_record("overlays", default_value=json.dumps({})))
         if "git" in overlayRecord.values():
             __worldNeeded("dev-vcs/git")
@@ -236,6 +343,7 @@ class Builder:
         # create installList
         ORDER = [
             "dev-util/ccache",
+            "sys-devel/distcc",
         ]
         installList = sorted(install_list + list(world_set))
         for pkg in reversed(ORDER):
@@ -250,14 +358,31 @@ class Builder:
                 f.write("%s\n" % (pkg))
 
         # preprocess, install packages, update @world
-        with _MyChrooter(self) as m:
-            for s in preprocess_script_list:
-                m.script_exec(s, quiet=self._getQuiet())
+        with self._chrooter() as m:
+            m.script_exec_batch(preprocess_script_list, quiet=self._getQuiet())
 
             installList = [x for x in installList if not Util.portageIsPkgInstalled(self._workDirObj.chroot_dir_path, x)]
-            m.script_exec(ScriptInstallPackages(installList, self._s.verbose_level), quiet=self._getQuiet())
-
-            m.script_exec(ScriptUpdateWorld(self._s.verbose_level), quiet=self._getQuiet())
+            emergeJobs = None
+            if self._buildTimeDb is not None or self._s.prefetch_distfiles:
+                mergeList = self._resolveMergeList(m, ["@world"] + [x for x in installList if x not in world_set])
+                if mergeList is not None and self._buildTimeDb is not None:
+                    emergeJobs = self._estimateMergeList(mergeList)
+                if mergeList is not None and self._s.prefetch_distfiles:
+                    self._prefetchDistfiles(m, [x[0] for x in mergeList if not x[1]])
+            try:
+                with self._watchEmergeLog(m) as emergeLogDir, self._controlPressure(m):
+                    if "sys-devel/distcc" in installList:
+                        # compile jobs can be sent to distcc servers only after distcc is installed
+                        m.script_exec(ScriptInstallPackages(["sys-devel/distcc"], self._s.verbose_level, emergeLogDir), quiet=self._getQuiet())
+                        TargetConfDirWriter(self._s, self._ts, self._workDirObj.chroot_dir_path).write_package_env()
+                        installList.remove("sys-devel/distcc")
+                    if len(installList) > 0:
+                        m.script_exec(ScriptInstallPackages(installList, self._s.verbose_level, emergeLogDir), quiet=self._getQuiet())
+                    tl = TargetConfDirParser(self._workDirObj.chroot_dir_path).get_make_conf_load_average()
+                    m.script_exec(ScriptUpdateWorld(self._s.verbose_level, emergeJobs, tl, emergeLogDir), quiet=self._getQuiet())
+            finally:
+                with self._etaLock:
+                    self._etaDict = None
 
     @Action(BuildStep.WORLD_UPDATED)
     def action_install_kernel(self, preprocess_script_list=[]):
@@ -272,16 +397,15 @@ class Builder:
             tj = t.get_make_conf_make_opts_jobs()
             tl = t.get_make_conf_load_average()
 
-            with _MyChrooter(self) as m:
-                for s in preprocess_script_list:
-                    m.script_exec(s, quiet=self._getQuiet())
+            with self._chrooter() as m:
+                m.script_exec_batch(preprocess_script_list, quiet=self._getQuiet())
 
                 m.shell_call("", "eselect kernel set 1")
 
                 dotConfigFile = "/usr/src/dot-config"
                 if not os.path.exists(os.path.join(self._workDirObj.chroot_dir_path, dotConfigFile[1:])):
                     dotConfigFile = None
-                m.script_exec(ScriptGenkernel(self._s.verbose_level, tj, tl, self._ts.build_opts.ccache, dotConfigFile), quiet=self._getQuiet())
+                m.script_exec(ScriptGenkernel(self._s.verbose_level, tj, tl, self._ts.build_opts.ccache, dotConfigFile, self._ts.kern_build_opts), quiet=self._getQuiet())
 
             return
 
@@ -308,9 +432,8 @@ class Builder:
             return
 
         if len(service_list) > 0:
-            with _MyChrooter(self) as m:
-                for s in preprocess_script_list:
-                    m.script_exec(s, quiet=self._getQuiet())
+            with self._chrooter() as m:
+                m.script_exec_batch(preprocess_script_list, quiet=self._getQuiet())
                 for s in service_list:
                     if self._ts.service_manager == "openrc":
                         m.shell_exec("", "rc-update add %s default > /dev/null" % (s))
@@ -324,13 +447,12 @@ class Builder:
         assert all([isinstance(s, ScriptInChroot) for s in custom_script_list])
 
         if len(custom_script_list) > 0:
-            with _MyChrooter(self) as m:
-                for s in custom_script_list:
-                    m.script_exec(s, quiet=self._getQuiet())
+            with self._chrooter() as m:
+                m.script_exec_batch(custom_script_list, quiet=self._getQuiet())
 
     @Action(BuildStep.CONFDIR_INITIALIZED, BuildStep.OVERLAYS_CREATED, BuildStep.WORLD_UPDATED, BuildStep.KERNEL_INSTALLED, BuildStep.SERVICES_ENABLED, BuildStep.SYSTEM_CUSTOMIZED)
     def action_cleanup(self):
-        with _MyChrooter(self) as m:
+        with self._chrooter() as m:
             if not self._ts.degentoo:
                 m.shell_call("", "eselect news read all")
                 m.script_exec(ScriptDepClean(self._s.verbose_level), quiet=self._getQuiet())
@@ -340,10 +462,14 @@ class Builder:
                 # m.shell_exec("", "%s/run-merge.sh -C sys-devel/gcc" % (scriptDirPath))
                 # m.shell_exec("", "%s/run-merge.sh -C sys-apps/portage" % (scriptDirPath))
 
+        # this is the last action, the result must not carry any mount, and the directories below may be mount points
+        self._unbindSessionChrooter()
+
         if not self._ts.degentoo:
             t = TargetConfDirCleaner(self._workDirObj.chroot_dir_path)
             t.cleanup_repos_conf_dir()
             t.cleanup_make_conf()
+            t.cleanup_package_env()
         else:
             # FIXME
             t = TargetFilesAndDirs(self._workDirObj.chroot_dir_path)
@@ -355,13 +481,215 @@ class Builder:
             robust_layer.simple_fops.rm(t.distdir_hostpath)
             robust_layer.simple_fops.rm(t.binpkgdir_hostpath)
 
+    @contextlib.contextmanager
+    def _watchEmergeLog(self, m):
+        # yields EMERGE_LOG_DIR (in chroot) for the emerge runs to be watched
+        # emerge.log is shared by all the emerge runs in chroot, so the watched ones write their own log, which is appended
+        # to the shared one afterwards
+        t = TargetFilesAndDirs(self._workDirObj.chroot_dir_path)
+        logDir = self._s.log_dir if self._s.log_dir is not None else t.logdir_hostpath
+        name = "emerge-%s" % (uuid.uuid4().hex[:8])
+        path = os.path.join(logDir, name, "emerge.log")
+        os.makedirs(os.path.dirname(path))
+
+        def __callback(event):
+            if event.type in [EmergeEvent.FINISH, EmergeEvent.FAIL]:
+                with self._etaLock:
+                    if self._etaDict is not None:
+                        self._etaDict.pop(event.package, None)
+            if event.type == EmergeEvent.FINISH and self._buildTimeDb is not None:
+                self._addBuildTimeRecord(event, usageMonitor)
+            for callback in self._emergeCallbackList:
+                # a failed callback must not prevent the others from being called
+                try:
+                    callback(event)
+                except Exception:
+                    print("Emerge event callback %r failed for %s %s:" % (callback, event.type, event.package))
+                    traceback.print_exc()
+
+        usageMonitor = BuildUsageMonitor(self._workDirObj.chroot_dir_path, m.cgroup)
+        try:
+            with contextlib.ExitStack() as stack:
+                if self._buildTimeDb is not None:
+                    stack.enter_context(usageMonitor)
+                stack.enter_context(EmergeLogWatcher(path, __callback))
+                yield os.path.join(t.logdir_path, name)
+        finally:
+            if os.path.exists(path):
+                with open(os.path.join(logDir, "emerge.log"), "ab") as dst, open(path, "rb") as src:
+                    shutil.copyfileobj(src, dst)
+            robust_layer.simple_fops.rm(os.path.dirname(path))
+
+    @contextlib.contextmanager
+    def _controlPressure(self, m):
+        if not self._s.pressure_control:
+            yield
+            return
+        with PressureController(self._workDirObj.chroot_dir_path, m.cgroup, quiet=self._getQuiet()):
+            yield
+
+    def _resolveMergeList(self, m, targetList):
+        # returns list<(cpv-with-repo, is-binary, use-flag-list)> of the packages to be merged, None if dependency resolution fails
+        try:
+            out = m.shell_call("", "emerge -pv --color=n -uDN --with-bdeps=y %s" % (" ".join(targetList)))
+        except subprocess.CalledProcessError:
+            # dependency resolution failure is reported by the real emerge run
+            return None
+
+        # line format: [ebuild  N     ] category/pf:slot::repo  USE="a -b (c) d*" PYTHON_TARGETS="python3_11 -python3_12" 0 KiB
+        ret = []
+        for line in out.split("\n"):
+            mt = re.match(r"\[(ebuild|binary)[^\]]*\]\s+(\S+)", line)
+            if mt is None:
+                continue
+            cpv = mt.group(2).split(":")[0]
+            if "::" in mt.group(2):
+                cpv += "::" + mt.group(2).split("::")[1]
+            useList = []
+            for var, value in re.findall(r"\b([A-Z0-9_]+)=\"([^\"]*)\"", line[mt.end():]):
+                for flag in value.split():
+                    # "-" for disabled flags, "()" for forced or masked ones, "*" and "%" for changed and new ones
+                    flag = flag.strip("(){}*%")
+                    if flag.startswith("-") or flag == "":
+                        continue
+                    useList.append(flag if var == "USE" else "%s_%s" % (var.lower(), flag))
+            ret.append((cpv, mt.group(1) == "binary", useList))
+        return ret
+
+    def _estimateMergeList(self, mergeList):
+        # records estimated build time of the packages to be merged for get_eta(), returns suggested emerge jobs
+        configKey = self._ts.get_build_config_key()
+        etaDict = dict()
+        for cpv, binary, useList in mergeList:
+            cpv = cpv.split("::")[0]
+            etaDict[cpv] = self._buildTimeDb.estimate(cpv, configKey, useList) if not binary else 0
+
+        ret = BuildTimeDatabase.suggest_emerge_jobs(list(etaDict.values()), self._s.host_computing_power.cpu_core_count)
+        with self._etaLock:
+            self._etaDict = etaDict
+            self._etaJobs = ret if ret is not None else TargetConfDirParser(self._workDirObj.chroot_dir_path).get_make_conf_emerge_jobs()
+        return ret
+
+    def _prefetchDistfiles(self, m, cpvList):
+        # distfiles are listed by portage in chroot, and downloaded concurrently from host
+        if len(cpvList) == 0:
+            return
+        with Profiler.span("Prefetch distfiles", "fetch"):
+            # prefetching is an optimization, emerge fetches the files itself if distfiles can't be listed
+            try:
+                out = m.shell_call("", "python3 -c %s %s" % (shlex.quote(_FETCH_MAP_SCRIPT), " ".join([shlex.quote(x) for x in cpvList])))
+                fetchMap = json.loads(out.split("\n")[-1])        # warnings may be printed before the result
+            except (subprocess.CalledProcessError, ValueError) as e:
+                print("Failed to list distfiles, prefetching is skipped: %s" % (e))
+                return
+            p = DistfilePrefetcher(self._s.host_distfiles_dir, self._s.network_jobs, self._s.prefetch_mirrors, quiet=self._getQuiet())
+            for fn, v in fetchMap.items():
+                p.add_file(fn, v["uris"], v["size"], v["hashes"])
+            p.run()
+
+    def _addBuildTimeRecord(self, event, usageMonitor):
+        peakRss, diskUsage = usageMonitor.pop_usage(event.package)
+
+        pkgDir = os.path.join(TargetFilesAndDirs(self._workDirObj.chroot_dir_path).pkgdbdir_hostpath, event.package)
+        if os.path.exists(os.path.join(pkgDir, "BINPKGMD5")):
+            # merged from a binary package, it is not a build
+            return
+
+        # only flags in IUSE are recorded, as "emerge -pv" shows them, see _resolveMergeList()
+        try:
+            iuse = set([x.lstrip("+-") for x in pathlib.Path(pkgDir, "IUSE").read_text().split()])
+            useList = [x for x in pathlib.Path(pkgDir, "USE").read_text().split() if x in iuse]
+        except FileNotFoundError:
+            useList = []
+
+        self._buildTimeDb.add_record(event.package, self._ts.get_build_config_key(), useList, event.duration, peakRss, diskUsage)
+
+    def _getHostPackagesDir(self):
+        # returns the directory in host_packages_dir used by this target
+        if not self._s.binpkg_reuse:
+            return self._s.host_packages_dir
+        ret = os.path.join(self._s.host_packages_dir, self._ts.get_build_config_key())
+        os.makedirs(ret, exist_ok=True)
+        return ret
+
+    def _writeProfile(self):
+        # written after every action, so that there's a report even if the build fails
+        # errors are printed instead of being raised, they must not replace the result of the action
+        if self._s.log_dir is not None:
+            try:
+                records = self._accounting.get_records()
+                self._profiler.write_report(os.path.join(self._s.log_dir, "gstage4-profile.json"), records)
+                self._profiler.write_chrome_trace(os.path.join(self._s.log_dir, "gstage4-trace.json"), records)
+            except Exception as e:
+                print("Failed to write profile: %s" % (e))
+
     def _getChrootDirName(self):
         return "%02d-%s" % (self._progress.value, self._progress.name)
 
+    @contextlib.contextmanager
+    def _chrooter(self):
+        if self._sessionThreadId is None:
+            with _MyChrooter(self) as m:
+                yield m
+            return
+
+        assert self._sessionThreadId == threading.get_ident()
+        if self._sessionChrooter is None:
+            m = _MyChrooter(self)
+            m.bind()
+            self._sessionChrooter = m
+        else:
+            self._sessionChrooter.refresh()
+        yield self._sessionChrooter
+
+    def _unbindSessionChrooter(self):
+        if self._sessionChrooter is None:
+            return
+
+        if self._workDirObj.is_chroot_dir_opened():
+            self._sessionChrooter.unbind()
+        else:
+            # the mounts are now in the closed chroot directory
+            self._workDirObj.open_chroot_dir(from_dir_name=self._getChrootDirName())
+            self._sessionChrooter.unbind()
+            self._workDirObj.close_chroot_dir(to_dir_name=self._getChrootDirName())
+        self._sessionChrooter = None
+
     def _getQuiet(self):
         return (self._s.verbose_level == 0)
 
 
+# prints distfiles (with their URIs and Manifest digests) needed by the specified packages with their effective USE flags
+# mirror:// URIs are expanded, and fetch restricted packages are skipped
+_FETCH_MAP_SCRIPT = """
+import os, sys, json, hashlib, portage
+portdb = portage.db[portage.root]["porttree"].dbapi
+settings = portage.config(clone=portage.settings)
+mirrors = settings.thirdpartymirrors()
+ret = dict()
+for cpv in sys.argv[1:]:
+    cpv, repo = cpv.split("::") if "::" in cpv else (cpv, None)
+    if "fetch" in portdb.aux_get(cpv, ["RESTRICT"], myrepo=repo)[0].split():
+        continue
+    settings.setcpv(cpv, mydb=portdb)
+    fetchMap = portdb.getFetchMap(cpv, useflags=settings["PORTAGE_USE"].split(), mytree=None if repo is None else portdb.getRepositoryPath(repo))
+    digests = portage.manifest.Manifest(os.path.dirname(portdb.findname(cpv, myrepo=repo)), settings["DISTDIR"]).getTypeDigests("DIST")
+    for fn, uris in fetchMap.items():
+        uriList = []
+        for m in settings.get("GENTOO_MIRRORS", "").split():
+            uriList.append("%s/distfiles/%s/%s" % (m.rstrip("/"), hashlib.blake2b(fn.encode()).hexdigest()[:2], fn))
+        for uri in uris:
+            if uri.startswith("mirror://"):
+                name, path = uri[len("mirror://"):].split("/", 1)
+                uriList += ["%s/%s" % (x.rstrip("/"), path) for x in mirrors.get(name, [])]
+            else:
+                uriList.append(uri)
+        d = digests.get(fn, dict())
+        ret[fn] = {"uris": uriList, "size": d.get("size"), "hashes": {k: v for k, v in d.items() if k != "size"}}
+print(json.dumps(ret))
+"""
+
+
 class _MyRepoUtil:
 
     @classmethod
@@ -469,56 +797,107 @@ class _MyRepo:
 class _MyChrooter(Runner):
 
     def __init__(self, parent):
-        super().__init__(parent._workDirObj.chroot_dir_path)
+        cgroup = None
+        if parent._s.use_cgroup:
+            s = parent._s
+            cpuCount = s.cgroup_cpu_count if s.cgroup_cpu_count is not None else s.host_computing_power.cpu_core_count
+            memoryMax = s.cgroup_memory_max if s.cgroup_memory_max is not None else s.host_computing_power.memory_size
+            cgroup = CGroup("%d-%s" % (os.getpid(), uuid.uuid4().hex[:8]),
+                            cpu_count=cpuCount,
+                            memory_high=memoryMax * 9 // 10,        # throttle before being OOM-killed
+                            memory_max=memoryMax,
+                            io_weight=s.cgroup_io_weight)
+
+        # in session mode the chroot is kept bound across actions, so a persistent executor pays off
+        super().__init__(parent._workDirObj.chroot_dir_path, persistent_executor=(parent._sessionThreadId is not None), cgroup=cgroup)
         self._p = parent
         self._w = parent._workDirObj
         self._bindMountList = []
 
     def bind(self):
-        super().bind()
-        try:
+        with Profiler.span("Bind chroot", "mount"):
+            super().bind()
+            try:
+                self._bindTargetDirs()
+            except BaseException:
+                self.unbind(remove_scripts=False)
+                raise
+
+    def refresh(self):
+        # mount the directories and repositories which are created after bind(), used in session mode
+        with Profiler.span("Refresh chroot", "mount"):
+            self._bindTargetDirs()
+
+    def _bindTargetDirs(self):
+        t = TargetFilesAndDirs(self._w.chroot_dir_path)
+
+        # log directory mount point
+        if self._p._s.log_dir is not None and t.logdir_hostpath not in self._bindMountList:
+            self._mount(t.logdir_hostpath, self._p._s.log_dir, None, MS_BIND, mountList=self._bindMountList)
+
+        # distdir mount point
+        if self._p._s.host_distfiles_dir is not None and t.distdir_hostpath not in self._bindMountList:
+            self._mount(t.distdir_hostpath, self._p._s.host_distfiles_dir, None, MS_BIND, mountList=self._bindMountList)
+
+        # pkgdir mount point
+        if self._p._s.host_packages_dir is not None and t.binpkgdir_hostpath not in self._bindMountList:
+            self._mount(t.binpkgdir_hostpath, self._p._getHostPackagesDir(), None, MS_BIND, mountList=self._bindMountList)
+
+        # ccachedir mount point
+        if self._p._s.host_ccache_dir is not None and os.path.exists(t.ccachedir_hostpath) and t.ccachedir_hostpath not in self._bindMountList:
+            self._mount(t.ccachedir_hostpath, self._p._s.host_ccache_dir, None, MS_BIND, mountList=self._bindMountList)
+
+        # tmpfs for PORTAGE_TMPDIR, it keeps the owner and mode of the original directory
+        if self._p._s.tmpfs_portage_tmpdir and t.portage_tmpdir_hostpath not in self._bindMountList:
+            if not os.path.exists(t.portage_tmpdir_hostpath):
+                os.makedirs(t.portage_tmpdir_hostpath, mode=0o775)
+            st = os.stat(t.portage_tmpdir_hostpath)
+            size = self._p._s.tmpfs_portage_tmpdir_size
+            if size is None:
+                size = self._p._s.host_computing_power.memory_size // 2
+            data = "size=%d,mode=%o,uid=%d,gid=%d" % (size, stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid)
+            self._mount(t.portage_tmpdir_hostpath, "tmpfs", "tmpfs", 0, mountList=self._bindMountList, data=data)
+
+        # mount points for MountRepository
+        for myRepo in _MyRepoUtil.scanReposConfDir(self._w.chroot_dir_path):
+            mp = myRepo.get_mount_params()
+            if mp is not None and myRepo.datadir_hostpath not in self._bindMountList:
+                self._mountRepo(myRepo.datadir_hostpath, mp[0], mp[1])
+
+    def unbind(self, remove_scripts=True):
+        with Profiler.span("Unbind chroot", "mount"):
             t = TargetFilesAndDirs(self._w.chroot_dir_path)
-
-            # log directory mount point
-            if self._p._s.log_dir is not None:
-                assert os.path.exists(t.logdir_hostpath) and not Util.isMount(t.logdir_hostpath)
-                Util.shellCall("mount --bind \"%s\" \"%s\"" % (self._p._s.log_dir, t.logdir_hostpath))
-                self._bindMountList.append(t.logdir_hostpath)
-
-            # distdir mount point
-            if self._p._s.host_distfiles_dir is not None:
-                assert os.path.exists(t.distdir_hostpath) and not Util.isMount(t.distdir_hostpath)
-                Util.shellCall("mount --bind \"%s\" \"%s\"" % (self._p._s.host_distfiles_dir, t.distdir_hostpath))
-                self._bindMountList.append(t.distdir_hostpath)
-
-            # pkgdir mount point
-            if self._p._s.host_packages_dir is not None:
-                assert os.path.exists(t.binpkgdir_hostpath) and not Util.isMount(t.binpkgdir_hostpath)
-                Util.shellCall("mount --bind \"%s\" \"%s\"" % (self._p._s.host_packages_dir, t.binpkgdir_hostpath))
-                self._bindMountList.append(t.binpkgdir_hostpath)
-
-            # ccachedir mount point
-            if self._p._s.host_ccache_dir is not None and os.path.exists(t.ccachedir_hostpath):
-                assert os.path.exists(t.ccachedir_hostpath) and not Util.isMount(t.ccachedir_hostpath)
-                Util.shellCall("mount --bind \"%s\" \"%s\"" % (self._p._s.host_ccache_dir, t.ccachedir_hostpath))
-                self._bindMountList.append(t.ccachedir_hostpath)
-
-            # mount points for MountRepository
-            for myRepo in _MyRepoUtil.scanReposConfDir(self._w.chroot_dir_path):
-                mp = myRepo.get_mount_params()
-                if mp is not None:
-                    assert os.path.exists(myRepo.datadir_hostpath) and not Util.isMount(myRepo.datadir_hostpath)
-                    Util.shellCall("mount \"%s\" \"%s\" -o %s" % (mp[0], myRepo.datadir_hostpath, (mp[1] + ",ro") if mp[1] != "" else "ro"))
-                    self._bindMountList.append(myRepo.datadir_hostpath)
-        except BaseException:
-            self.unbind(remove_scripts=False)
-            raise
-
-    def unbind(self):
-        for fullfn in reversed(self._bindMountList):
-            Util.cmdCall("umount", "-l", fullfn)
-        self._bindMountList = []
-        super().unbind()
+            if t.portage_tmpdir_hostpath in self._bindMountList:
+                # the tmpfs and the log directory are only visible in the mount namespace
+                self._inMntNs(self._saveBuildLogs, t)
+            for fullfn in reversed(self._bindMountList):
+                self._umount(fullfn)
+            self._bindMountList = []
+            super().unbind(remove_scripts)
+
+    def _saveBuildLogs(self, t):
+        # build logs of the failed packages are kept in PORTAGE_TMPDIR, copy them out before the tmpfs is gone
+        # file names are in the same format as the ones in PORT_LOGDIR
+        for fullfn in glob.glob(os.path.join(t.portage_tmpdir_hostpath, "*", "*", "temp", "build.log")):
+            category, pf = fullfn.split("/")[-4:-2]
+            try:
+                os.makedirs(t.logdir_hostpath, exist_ok=True)
+                dstFn = "%s:%s:%s.log" % (category, pf, time.strftime("%Y%m%d-%H%M%S", time.localtime(os.path.getmtime(fullfn))))
+                shutil.copyfile(fullfn, os.path.join(t.logdir_hostpath, dstFn))
+            except OSError as e:
+                print("Failed to save build log of %s/%s: %s" % (category, pf, e))
+
+    def _mountRepo(self, fullfn, source, options):
+        optList = [x for x in options.split(",") if x != ""]
+        if optList == ["bind"]:
+            # read-only bind mount needs a remount
+            self._mount(fullfn, source, None, MS_BIND, mountList=self._bindMountList)
+            self._inMntNs(Util.mount, None, fullfn, None, MS_BIND | MS_REMOUNT | MS_RDONLY)
+        else:
+            # mounting a file needs loop device setup, leave it to mount command, which is spawned in the mount namespace
+            assert os.path.exists(fullfn) and not self._inMntNs(self._mountTable.is_mount, fullfn)
+            self._inMntNs(Util.cmdCall, "mount", source, fullfn, "-o", ",".join(optList + ["ro"]))
+            self._bindMountList.append(fullfn)
 
 
 class TargetFilesAndDirs:
@@ -558,6 +937,14 @@ class TargetFilesAndDirs:
     def srcdir_path(self):
         return "/usr/src"
 
+    @property
+    def portage_tmpdir_path(self):
+        return "/var/tmp/portage"
+
+    @property
+    def notmpfs_tmpdir_path(self):
+        return "/var/tmp/notmpfs"
+
     @property
     def world_file_path(self):
         return "/var/lib/portage/world"
@@ -594,6 +981,14 @@ class TargetFilesAndDirs:
     def srcdir_hostpath(self):
         return os.path.join(self._chroot_path, self.srcdir_path[1:])
 
+    @property
+    def portage_tmpdir_hostpath(self):
+        return os.path.join(self._chroot_path, self.portage_tmpdir_path[1:])
+
+    @property
+    def notmpfs_tmpdir_hostpath(self):
+        return os.path.join(self._chroot_path, self.notmpfs_tmpdir_path[1:])
+
     @property
     def world_file_hostpath(self):
         return os.path.join(self._chroot_path, self.world_file_path[1:])
@@ -604,29 +999,21 @@ class TargetConfDirWriter:
     def __init__(self, settings, targetSettings, chrootDir):
         self._s = settings
         self._ts = targetSettings
+        self._chrootDir = chrootDir
         self._dir = TargetFilesAndDirs(chrootDir).confdir_hostpath
 
     def write_make_conf(self):
         # determine parallelism parameters
-        paraMakeOpts = None
-        paraEmergeOpts = None
-        if True:
-            if self._s.host_computing_power.cooling_level <= 1:
-                jobcountMake = 1
-                jobcountEmerge = 1
-                loadavg = 1
-            else:
-                if self._s.host_computing_power.memory_size >= 24 * 1024 * 1024 * 1024:       # >=24G
-                    jobcountMake = self._s.host_computing_power.cpu_core_count + 2
-                    jobcountEmerge = self._s.host_computing_power.cpu_core_count
-                    loadavg = self._s.host_computing_power.cpu_core_count
-                else:
-                    jobcountMake = self._s.host_computing_power.cpu_core_count
-                    jobcountEmerge = self._s.host_computing_power.cpu_core_count
-                    loadavg = max(1, self._s.host_computing_power.cpu_core_count - 1)
+        jobcountMake, jobcountEmerge, loadavg = self._getJobCounts()
+        paraMakeOpts = self._getMakeOpts(jobcountMake, loadavg)
+        paraEmergeOpts = ["--jobs=%d" % (jobcountEmerge), "--load-average=%d" % (loadavg)]
 
-            paraMakeOpts = ["--jobs=%d" % (jobcountMake), "--load-average=%d" % (loadavg), "-j%d" % (jobcountMake), "-l%d" % (loadavg)]     # for bug 559064 and 592660, we need to add -j and -l, it sucks
-            paraEmergeOpts = ["--jobs=%d" % (jobcountEmerge), "--load-average=%d" % (loadavg)]
+        # use binary packages built with the same configuration, see Settings.binpkg_reuse
+        binpkgEmergeOpts = []
+        if self._s.binpkg_reuse:
+            binpkgEmergeOpts.append("--usepkg")
+        if self._s.binpkg_reuse or len(self._s.binhost_urls) > 0:
+            binpkgEmergeOpts += ["--binpkg-respect-use=y", "--binpkg-changed-deps=y"]
 
         # define helper functions
         def __flagsWrite(flags, value):
@@ -652,10 +1039,26 @@ class TargetConfDirWriter:
             featureList = []
             if self._ts.build_opts.ccache:
                 featureList.append("ccache")
+            if self._s.binpkg_reuse:
+                featureList.append("buildpkg")
+            if len(self._s.binhost_urls) > 0:
+                featureList.append("getbinpkg")
             if len(featureList) > 0:
                 myf.write('FEATURES="%s"\n' % (" ".join(featureList)))
                 myf.write('\n')
 
+            # binary packages, BinhostServer can only index packages in xpak format
+            if self._s.binpkg_reuse:
+                myf.write('BINPKG_FORMAT="xpak"\n')
+            if len(self._s.binhost_urls) > 0:
+                if self._s.binpkg_reuse:
+                    binhostList = ["%s/%s" % (x.rstrip("/"), self._ts.get_build_config_key()) for x in self._s.binhost_urls]
+                else:
+                    binhostList = self._s.binhost_urls
+                myf.write('PORTAGE_BINHOST="%s"\n' % (" ".join(binhostList)))
+            if self._s.binpkg_reuse or len(self._s.binhost_urls) > 0:
+                myf.write('\n')
+
             # flags
             if self._ts.build_opts.common_flags is not None:
                 myf.write('COMMON_FLAGS="%s"\n' % (' '.join(self._ts.build_opts.common_flags)))
@@ -671,9 +1074,13 @@ class TargetConfDirWriter:
             myf.write('LC_MESSAGES=C\n')
             myf.write('\n')
 
+            # put emerge.log in log directory, so that it can be followed from host, see EmergeLogWatcher
+            myf.write('EMERGE_LOG_DIR="%s"\n' % (TargetFilesAndDirs(self._chrootDir).logdir_path))
+            myf.write('\n')
+
             # set MAKEOPTS and EMERGE_DEFAULT_OPTS
             myf.write('MAKEOPTS="%s"\n' % (' '.join(paraMakeOpts)))
-            myf.write('EMERGE_DEFAULT_OPTS="--quiet-build=y --autounmask --autounmask-continue --autounmask-license=y %s"\n' % (' '.join(paraEmergeOpts)))
+            myf.write('EMERGE_DEFAULT_OPTS="--quiet-build=y --autounmask --autounmask-continue --autounmask-license=y %s"\n' % (' '.join(paraEmergeOpts + binpkgEmergeOpts)))
             myf.write('\n')
 
     def write_package_use(self):
@@ -819,6 +1226,100 @@ class TargetConfDirWriter:
                 for use_flag in self._ts.use_mask:
                     myf.write("%s\n" % (use_flag))
 
+    def write_package_env(self):
+        # Modify and write out package.env and the environment files it uses (in chroot)
+        fpath = os.path.join(self._dir, "package.env")
+        envDir = os.path.join(self._dir, "env")
+        robust_layer.simple_fops.rm(fpath)
+
+        buf = ""
+        if len(self._s.distcc_hosts) > 0:
+            # compile jobs are sent to distcc servers, so make jobs are counted by all the cores, load average is still local
+            jobcountMake, jobcountEmerge, loadavg = self._getJobCounts()
+            hostList = ["%s/%d" % (k, v) for k, v in self._s.distcc_hosts.items()]
+            hostList.append("localhost/%d" % (jobcountMake))
+            os.makedirs(envDir, exist_ok=True)
+            with open(os.path.join(envDir, "distcc.conf"), "w") as myf:
+                myf.write('FEATURES="distcc"\n')
+                myf.write('MAKEOPTS="%s"\n' % (" ".join(self._getMakeOpts(jobcountMake + sum(self._s.distcc_hosts.values()), loadavg))))
+                myf.write('DISTCC_HOSTS="%s"\n' % (" ".join(hostList)))
+            if Util.portageIsPkgInstalled(self._chrootDir, "sys-devel/distcc"):
+                # packages are built with local MAKEOPTS until distcc is installed, see Builder.action_update_world()
+                buf += "*/* distcc.conf\n"
+
+        if len(self._ts.pkg_build_opts) > 0:
+            # lines after the distcc one, so that their job counts take precedence
+            fnSet = set()
+            for pkg_wildcard, buildOpts in self._ts.pkg_build_opts.items():
+                fn = "build-opts-%s" % (re.sub(r"[^A-Za-z0-9_.+-]", "_", pkg_wildcard))
+                while fn + ".conf" in fnSet:
+                    fn += "_"
+                fn += ".conf"
+                fnSet.add(fn)
+                os.makedirs(envDir, exist_ok=True)
+                with open(os.path.join(envDir, fn), "w") as myf:
+                    myf.write(self._getPackageBuildOptsEnv(buildOpts))
+                buf += "%s %s\n" % (pkg_wildcard, fn)
+
+        if self._s.tmpfs_portage_tmpdir:
+            # these packages need more space than a tmpfs can afford, build them on disk
+            t = TargetFilesAndDirs(self._chrootDir)
+            os.makedirs(t.notmpfs_tmpdir_hostpath, exist_ok=True)
+            os.makedirs(envDir, exist_ok=True)
+            with open(os.path.join(envDir, "notmpfs.conf"), "w") as myf:
+                myf.write('PORTAGE_TMPDIR="%s"\n' % (t.notmpfs_tmpdir_path))
+            for pkg_wildcard in self.NOTMPFS_PACKAGES:
+                buf += "%s notmpfs.conf\n" % (pkg_wildcard)
+
+        # create this file only if content is not empty
+        if buf != "":
+            with open(fpath, "w") as myf:
+                myf.write(buf)
+
+    def _getPackageBuildOptsEnv(self, buildOpts):
+        # only the specified flags override the global ones
+        buf = ""
+        if len(buildOpts.common_flags) > 0:
+            buf += 'COMMON_FLAGS="%s"\n' % (" ".join(buildOpts.common_flags))
+        for flags, value in [("CFLAGS", buildOpts.cflags), ("CXXFLAGS", buildOpts.cxxflags), ("FCFLAGS", buildOpts.fcflags), ("FFLAGS", buildOpts.fflags)]:
+            if len(value) > 0:
+                buf += '%s="%s"\n' % (flags, " ".join(value))
+            elif len(buildOpts.common_flags) > 0:
+                buf += '%s="${COMMON_FLAGS}"\n' % (flags)
+        for flags, value in [("LDFLAGS", buildOpts.ldflags), ("ASFLAGS", buildOpts.asflags)]:
+            if len(value) > 0:
+                buf += '%s="%s"\n' % (flags, " ".join(value))
+        if buildOpts.jobs is not None:
+            buf += 'MAKEOPTS="%s"\n' % (" ".join(self._getMakeOpts(buildOpts.jobs, self._getJobCounts()[2])))
+        return buf
+
+    def _getJobCounts(self):
+        # returns (make-jobs, emerge-jobs, load-average) for local host
+        if self._s.host_computing_power.cooling_level <= 1:
+            ret = [1, 1, 1]
+        elif self._s.host_computing_power.memory_size >= 24 * 1024 * 1024 * 1024:       # >=24G
+            ret = [self._s.host_computing_power.cpu_core_count + 2, self._s.host_computing_power.cpu_core_count, self._s.host_computing_power.cpu_core_count]
+        else:
+            ret = [self._s.host_computing_power.cpu_core_count, self._s.host_computing_power.cpu_core_count, max(1, self._s.host_computing_power.cpu_core_count - 1)]
+
+        if self._ts.build_opts.jobs is not None:
+            ret[0] = self._ts.build_opts.jobs
+        return tuple(ret)
+
+    @staticmethod
+    def _getMakeOpts(jobcountMake, loadavg):
+        # for bug 559064 and 592660, we need to add -j and -l, it sucks
+        return ["--jobs=%d" % (jobcountMake), "--load-average=%d" % (loadavg), "-j%d" % (jobcountMake), "-l%d" % (loadavg)]
+
+    NOTMPFS_PACKAGES = [
+        "dev-lang/rust",
+        "dev-qt/qtwebengine",
+        "sys-devel/gcc",
+        "sys-devel/llvm",
+        "www-client/chromium",
+        "www-client/firefox",
+    ]
+
 
 class TargetConfDirParser:
 
@@ -838,6 +1339,13 @@ class TargetConfDirParser:
 
         assert False
 
+    def get_make_conf_emerge_jobs(self):
+        buf = pathlib.Path(os.path.join(self._dir, "make.conf")).read_text()
+        m = re.search("EMERGE_DEFAULT_OPTS=\".*--jobs=([0-9]+).*\"", buf, re.M)
+        if m is not None:
+            return int(m.group(1))
+        assert False
+
     def get_make_conf_load_average(self):
         buf = pathlib.Path(os.path.join(self._dir, "make.conf")).read_text()
         m = re.search("EMERGE_DEFAULT_OPTS=\".*--load-average=([0-9]+).*\"", buf, re.M)
@@ -849,6 +1357,7 @@ class TargetConfDirParser:
 class TargetConfDirCleaner:
 
     def __init__(self, chrootDir):
+        self._chrootDir = chrootDir
         self._dir = TargetFilesAndDirs(chrootDir).confdir_hostpath
 
     def cleanup_repos_conf_dir(self):
@@ -859,6 +1368,37 @@ class TargetConfDirCleaner:
         Util.shellCall("sed -i 's/--autounmask-continue//g' %s/make.conf" % (self._dir))
         Util.shellCall("sed -i 's/--autounmask-license=y//g' %s/make.conf" % (self._dir))
         Util.shellCall("sed -i 's/--autounmask//g' %s/make.conf" % (self._dir))
+        Util.shellCall("sed -i '/^EMERGE_LOG_DIR=/d' %s/make.conf" % (self._dir))
+        Util.shellCall("sed -i 's/--usepkg//g' %s/make.conf" % (self._dir))
+        Util.shellCall("sed -i 's/--binpkg-respect-use=y//g' %s/make.conf" % (self._dir))
+        Util.shellCall("sed -i 's/--binpkg-changed-deps=y//g' %s/make.conf" % (self._dir))
+        Util.shellCall("sed -i '/^BINPKG_FORMAT=/d' %s/make.conf" % (self._dir))
+        Util.shellCall("sed -i '/^PORTAGE_BINHOST=/d' %s/make.conf" % (self._dir))
+        self._removeFeature("buildpkg")
+        self._removeFeature("getbinpkg")
+
+    def cleanup_package_env(self):
+        fpath = os.path.join(self._dir, "package.env")
+        if os.path.exists(fpath):
+            Util.shellCall("sed -i '/ distcc.conf$/d' %s" % (fpath))
+            Util.shellCall("sed -i '/ notmpfs.conf$/d' %s" % (fpath))
+            if os.path.getsize(fpath) == 0:
+                robust_layer.simple_fops.rm(fpath)
+        robust_layer.simple_fops.rm(os.path.join(self._dir, "env", "distcc.conf"))
+        robust_layer.simple_fops.rm(os.path.join(self._dir, "env", "notmpfs.conf"))
+        robust_layer.simple_fops.rm(TargetFilesAndDirs(self._chrootDir).notmpfs_tmpdir_hostpath)
+
+    def _removeFeature(self, feature):
+        fpath = os.path.join(self._dir, "make.conf")
+        buf = pathlib.Path(fpath).read_text()
+
+        def __sub(m):
+            featureList = [x for x in m.group(1).split() if x != feature]
+            return 'FEATURES="%s"\n' % (" ".join(featureList)) if len(featureList) > 0 else ""
+
+        buf = re.sub(r'^FEATURES="(.*)"\n', __sub, buf, flags=re.M)
+        with open(fpath, "w") as f:
+            f.write(buf)
 
 
 class ScriptSync(ScriptFromBuffer):
@@ -880,8 +1420,10 @@ emerge --sync || exit 1
 
 class ScriptInstallPackages(ScriptFromBuffer):
 
-    def __init__(self, pkgList, verbose_level):
+    def __init__(self, pkgList, verbose_level, emerge_log_dir=None):
         buf = self._scriptContentFirstHalf
+        if emerge_log_dir is not None:
+            buf += "export EMERGE_LOG_DIR=%s\n" % (shlex.quote(emerge_log_dir))
         if verbose_level == 0:
             buf += self._scriptContentSecondHalfVerboseLv0
         elif verbose_level == 1:
@@ -930,8 +1472,10 @@ test ${PIPESTATUS[0]} -eq 0 || exit 1
 
 class ScriptUpdateWorld(ScriptFromBuffer):
 
-    def __init__(self, verbose_level):
+    def __init__(self, verbose_level, emerge_jobs=None, load_average=None, emerge_log_dir=None):
         buf = self._scriptContentFirstHalf
+        if emerge_log_dir is not None:
+            buf += "export EMERGE_LOG_DIR=%s\n" % (shlex.quote(emerge_log_dir))
         if verbose_level == 0:
             buf += self._scriptContentSecondHalfVerboseLv0
         elif verbose_level == 1:
@@ -942,6 +1486,14 @@ class ScriptUpdateWorld(ScriptFromBuffer):
             assert False
         buf += self._scriptContentThirdHalf
 
+        # options in command line override the ones in EMERGE_DEFAULT_OPTS
+        emergeOpts = ""
+        if emerge_jobs is not None:
+            emergeOpts += "--jobs=%d " % (emerge_jobs)
+        if load_average is not None:
+            emergeOpts += "--load-average=%d " % (load_average)
+        buf = buf.replace("@@EMERGE_OPTS@@", emergeOpts)
+
         super().__init__("Update @world", buf)
 
     _scriptContentFirstHalf = """
@@ -960,7 +1512,7 @@ export CONFIG_PROTECT="-* .x"
 """
 
     _scriptContentSecondHalfVerboseLv0 = """
-emerge --color=y -uDN --with-bdeps=y @world > /var/log/portage/run-update.log 2>&1 || exit 1
+emerge --color=y @@EMERGE_OPTS@@-uDN --with-bdeps=y @world > /var/log/portage/run-update.log 2>&1 || exit 1
 """
 
     _scriptContentSecondHalfVerboseLv1 = """
@@ -969,12 +1521,12 @@ emerge --color=y -uDN --with-bdeps=y @world > /var/log/portage/run-update.log 2>
 #   >>> Installing ...
 #   >>> Uninstalling ...
 #   >>> No outdated packages were found on your system.
-emerge --color=y -uDN --with-bdeps=y @world 2>&1 | tee /var/log/portage/run-update.log | grep -E --color=never "^>>> (.*\\(.*[0-9]+.*of.*[0-9]+.*\\)|No outdated packages .*)"
+emerge --color=y @@EMERGE_OPTS@@-uDN --with-bdeps=y @world 2>&1 | tee /var/log/portage/run-update.log | grep -E --color=never "^>>> (.*\\(.*[0-9]+.*of.*[0-9]+.*\\)|No outdated packages .*)"
 test ${PIPESTATUS[0]} -eq 0 || exit 1
 """
 
     _scriptContentSecondHalfVerboseLv2 = """
-emerge --color=y -uDN --with-bdeps=y @world 2>&1 | tee /var/log/portage/run-update.log
+emerge --color=y @@EMERGE_OPTS@@-uDN --with-bdeps=y @world 2>&1 | tee /var/log/portage/run-update.log
 test ${PIPESTATUS[0]} -eq 0 || exit 1
 """
 
@@ -985,7 +1537,7 @@ perl-cleaner --pretend --all >/dev/null 2>&1 || die "perl cleaning is needed, yo
 
 class ScriptGenkernel(ScriptFromBuffer):
 
-    def __init__(self, verbose_level, tj, tl, ccache, customDotConfigFile):
+    def __init__(self, verbose_level, tj, tl, ccache, customDotConfigFile, kernBuildOpts=None):
         buf = "#!/bin/bash\n"
         buf += "\n"
 
@@ -993,6 +1545,22 @@ class ScriptGenkernel(ScriptFromBuffer):
             buf += "export CCACHE_DIR=/var/tmp/ccache\n"
             buf += "\n"
 
+        # extra flags for kernel, they are appended to the ones of kbuild
+        # kernel has no C++ or fortran code, so cxxflags, fcflags and fflags are rejected by TargetSettings.check_object()
+        if kernBuildOpts is not None:
+            envDict = {
+                "KCFLAGS": kernBuildOpts.common_flags + kernBuildOpts.cflags,
+                "KAFLAGS": kernBuildOpts.common_flags + kernBuildOpts.asflags,
+                "LDFLAGS_MODULE": self._toLdFlags(kernBuildOpts.ldflags),       # modules are linked by ld directly
+            }
+            envDict = {k: v for k, v in envDict.items() if len(v) > 0}
+            for k, v in envDict.items():
+                buf += "export %s=%s\n" % (k, shlex.quote(" ".join(v)))
+            if len(envDict) > 0:
+                buf += "\n"
+            if kernBuildOpts.jobs is not None:
+                tj = kernBuildOpts.jobs
+
         cmd = ""
         if True:
             cmd += "genkernel --color --no-mountboot "
@@ -1014,6 +1582,17 @@ class ScriptGenkernel(ScriptFromBuffer):
 
         super().__init__("Install kernel", buf)
 
+    @staticmethod
+    def _toLdFlags(ldflags):
+        # "-Wl,-O1,--as-needed" -> ["-O1", "--as-needed"], flags for ld are passed as is
+        ret = []
+        for flag in ldflags:
+            if flag.startswith("-Wl,"):
+                ret += [x for x in flag[len("-Wl,"):].split(",") if x != ""]
+            else:
+                ret.append(flag)
+        return ret
+
 
 class ScriptDepClean(ScriptFromBuffer):
 
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import re
+import time
+import sqlite3
+import contextlib
+
+
+class BuildTimeDatabase:
+
+    """
+    Host side database of package build times, which is shared by builds.
+    It is stored in a SQLite file, concurrent access from different builds is serialized by SQLite.
+    A record belongs to a build configuration, which is TargetSettings.get_build_config_key() and the USE flags of the
+    package, build times of different configurations are never mixed. Peak memory and disk usage are recorded with
+    the build time.
+    """
+
+    _MAX_RECORDS_PER_CONFIG = 16
+
+    _MIN_COVERAGE = 0.5             # minimal ratio of the packages with history for suggest_emerge_jobs()
+
+    _COLUMNS = [
+        ("package", "TEXT NOT NULL"),
+        ("version", "TEXT NOT NULL"),
+        ("config", "TEXT NOT NULL DEFAULT ''"),         # TargetSettings.get_build_config_key()
+        ("use", "TEXT NOT NULL DEFAULT ''"),            # enabled USE flags in IUSE, sorted and separated by space
+        ("duration", "REAL NOT NULL"),
+        ("peak_rss", "INTEGER"),                        # bytes, of the largest process, NULL if not sampled
+        ("disk_usage", "INTEGER"),                      # bytes, of the build directory, NULL if not sampled
+        ("time", "INTEGER NOT NULL"),
+    ]
+
+    def __init__(self, path):
+        self._path = path
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS builds (%s)" % (", ".join(["%s %s" % (k, v) for k, v in self._COLUMNS])))
+
+            # records of old databases have no configuration, so they are never used by estimate() and expire in time
+            existing = [x[1] for x in conn.execute("PRAGMA table_info(builds)").fetchall()]
+            for k, v in self._COLUMNS:
+                if k not in existing:
+                    conn.execute("ALTER TABLE builds ADD COLUMN %s %s" % (k, v))
+
+            conn.execute("DROP INDEX IF EXISTS builds_package")
+            conn.execute("CREATE INDEX IF NOT EXISTS builds_package_config ON builds (package, config)")
+
+    @property
+    def path(self):
+        return self._path
+
+    def add_record(self, cpv, config, use_flags, duration, peak_rss=None, disk_usage=None):
+        # cpv is "category/name-version", config is TargetSettings.get_build_config_key()
+        # use_flags is list<flag> of the enabled USE flags in IUSE of the package
+        package, version = self.split_cpv(cpv)
+        use = " ".join(sorted(set(use_flags)))
+        with self._connect() as conn:
+            conn.execute("INSERT INTO builds (package, version, config, use, duration, peak_rss, disk_usage, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (package, version, config, use, duration, peak_rss, disk_usage, int(time.time())))
+
+            # only keep the latest records of a package in each configuration
+            conn.execute("DELETE FROM builds WHERE package = ? AND config = ? AND use = ? AND rowid NOT IN "
+                         "(SELECT rowid FROM builds WHERE package = ? AND config = ? AND use = ? ORDER BY time DESC LIMIT ?)",
+                         (package, config, use, package, config, use, self._MAX_RECORDS_PER_CONFIG))
+
+    def estimate(self, cpv, config, use_flags):
+        # returns estimated build duration in seconds, or None if the package has never been built with config
+        # records of the same USE flags are preferred to the others, and then records of the same version
+        package, version = self.split_cpv(cpv)
+        use = " ".join(sorted(set(use_flags)))
+        with self._connect() as conn:
+            rows = conn.execute("SELECT duration, use = ?, version = ? FROM builds WHERE package = ? AND config = ?",
+                                (use, version, package, config)).fetchall()
+        if len(rows) == 0:
+            return None
+        best = max([(x[1], x[2]) for x in rows])
+        durations = sorted([x[0] for x in rows if (x[1], x[2]) == best])
+        return durations[len(durations) // 2]
+
+    @staticmethod
+    def split_cpv(cpv):
+        # "dev-lang/python-3.11.7-r1" -> ("dev-lang/python", "3.11.7-r1")
+        m = re.fullmatch(r"(.+?)-([0-9][^-]*(?:-r[0-9]+)?)", cpv)
+        if m is None:
+            return (cpv, "")
+        return (m.group(1), m.group(2))
+
+    @staticmethod
+    def suggest_emerge_jobs(durations, max_jobs):
+        # durations is list<estimated-seconds-or-None>, None for packages without history, 0 for binary packages
+        # returns None if there are too few estimates to make a suggestion
+        # more emerge jobs help only if the work is spread over many packages, when a few packages dominate the build time,
+        # parallelism comes from make jobs in them instead
+        known = [x for x in durations if x is not None and x > 0]
+        unknownCount = len([x for x in durations if x is None])
+        if len(known) == 0 or len(known) < (len(known) + unknownCount) * BuildTimeDatabase._MIN_COVERAGE:
+            return None
+
+        # packages without history are counted as median ones
+        durations = known + [sorted(known)[len(known) // 2]] * unknownCount
+        return max(1, min(max_jobs, int(sum(durations) / max(durations))))
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self._path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
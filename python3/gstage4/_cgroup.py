@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import time
+import errno
+import signal
+from ._mounttable import MountTable
+
+
+class CGroup:
+
+    """
+    A cgroup v2 group, created under "gstage4" directory in the root of cgroup2 hierarchy.
+    Processes spawned with preexec_fn() and all their descendants are confined by the limits of the group.
+    Limits whose controller is not available (for example in hybrid hierarchy) are ignored.
+    """
+
+    def __init__(self, name, cpu_count=None, memory_high=None, memory_max=None, io_weight=None):
+        assert cpu_count is None or cpu_count > 0
+        assert memory_high is None or memory_high > 0
+        assert memory_max is None or memory_max > 0
+        assert io_weight is None or 1 <= io_weight <= 10000
+
+        self._name = name
+        self._cpuCount = cpu_count
+        self._memoryHigh = memory_high
+        self._memoryMax = memory_max
+        self._ioWeight = io_weight
+        self._path = None
+
+    @staticmethod
+    def is_supported():
+        return _getCgroup2MountPoint() is not None
+
+    @property
+    def path(self):
+        return self._path
+
+    def create(self):
+        assert self._path is None
+
+        root = _getCgroup2MountPoint()
+        if root is None:
+            raise OSError(errno.ENOENT, "cgroup2 filesystem is not mounted")
+
+        # controllers must be enabled along the path, "no internal process" rule does not apply to the root group
+        baseDir = os.path.join(root, "gstage4")
+        os.makedirs(baseDir, exist_ok=True)
+        ctrlList = [x for x in ["cpu", "memory", "io"] if x in self._readFile(root, "cgroup.controllers").split()]
+        for d in [root, baseDir]:
+            for c in ctrlList:
+                self._writeFile(d, "cgroup.subtree_control", "+" + c)
+
+        path = os.path.join(baseDir, self._name)
+        os.mkdir(path)
+        try:
+            if "cpu" in ctrlList and self._cpuCount is not None:
+                self._writeFile(path, "cpu.max", "%d 100000" % (self._cpuCount * 100000))
+            if "memory" in ctrlList:
+                # processes are throttled when exceeding memory.high, and get OOM-killed only when exceeding memory.max
+                if self._memoryMax is not None:
+                    self._writeFile(path, "memory.max", "%d" % (self._memoryMax))
+                if self._memoryHigh is not None:
+                    self._writeFile(path, "memory.high", "%d" % (self._memoryHigh))
+            if "io" in ctrlList and self._ioWeight is not None:
+                self._writeFile(path, "io.weight", "default %d" % (self._ioWeight))
+        except BaseException:
+            os.rmdir(path)
+            raise
+        self._path = path
+
+    def destroy(self, timeout=30):
+        # raises OSError(EBUSY) if processes in the group can't be removed in time, such as the ones stuck in uninterruptible sleep
+        if self._path is None:
+            return
+        deadline = time.monotonic() + timeout
+        self.kill(timeout)
+        while True:
+            try:
+                os.rmdir(self._path)
+                break
+            except OSError as e:
+                if e.errno != errno.EBUSY:      # killed processes are not reaped yet
+                    raise
+                if time.monotonic() >= deadline:
+                    raise OSError(errno.EBUSY, "failed to remove cgroup %s, processes are still alive after %d seconds" % (self._path, timeout))
+            time.sleep(0.1)
+        self._path = None
+
+    def kill(self, timeout=30):
+        # kills all the processes in the group, including the ones escaped from process group or session
+        # raises OSError(EBUSY) if there are still processes in the group after timeout
+        assert self._path is not None
+
+        if os.path.exists(os.path.join(self._path, "cgroup.kill")):
+            self._writeFile(self._path, "cgroup.kill", "1")
+            return
+
+        # cgroup.kill is added in linux-5.14, kill processes one by one until no one is left
+        deadline = time.monotonic() + timeout
+        while True:
+            pidList = [int(x) for x in self._readFile(self._path, "cgroup.procs").split()]
+            if len(pidList) == 0:
+                break
+            if time.monotonic() >= deadline:
+                raise OSError(errno.EBUSY, "failed to kill processes %s in cgroup %s after %d seconds" % (pidList, self._path, timeout))
+            for pid in pidList:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            time.sleep(0.1)
+
+    def get_pids(self):
+        assert self._path is not None
+        return [int(x) for x in self._readFile(self._path, "cgroup.procs").split()]
+
+    def get_cpu_stat(self):
+        # returns dict<key, value> from cpu.stat, such as "usage_usec", "user_usec", "system_usec"
+        assert self._path is not None
+
+        ret = dict()
+        for line in self._readFile(self._path, "cpu.stat").split("\n"):
+            if line != "":
+                k, v = line.split()
+                ret[k] = int(v)
+        return ret
+
+    def preexec_fn(self):
+        # to be called in the child process, moves it into the group
+        assert self._path is not None
+        self._writeFile(self._path, "cgroup.procs", "0")
+
+    @staticmethod
+    def _readFile(dirPath, name):
+        with open(os.path.join(dirPath, name), "r") as f:
+            return f.read()
+
+    @staticmethod
+    def _writeFile(dirPath, name, value):
+        with open(os.path.join(dirPath, name), "w") as f:
+            f.write(value)
+
+
+def _getCgroup2MountPoint():
+    # the hierarchy may also be mounted in chroot directories, use the top-most one
+    mt = MountTable.get_thread_instance()
+    mpList = [x for x in mt.get_mount_points() if mt.get_entry(x).fstype == "cgroup2"]
+    return min(mpList, key=len) if len(mpList) > 0 else None
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import time
+import hashlib
+import urllib.request
+import concurrent.futures
+from ._util import FileLock
+
+
+class DistfilePrefetcher:
+
+    """
+    Downloads distfiles into a distfiles directory concurrently, before they are needed by emerge.
+    Files are deduplicated by name, verified with the size and hashes from Manifest, and are moved into place only after
+    verification. Concurrent builds sharing the directory never download the same file at the same time.
+    URIs in mirrors are tried first, in the form of "<mirror>/<filename>".
+    """
+
+    _HASH_FUNCS = {
+        "BLAKE2B": hashlib.blake2b,
+        "SHA512": hashlib.sha512,
+        "SHA256": hashlib.sha256,
+    }
+
+    def __init__(self, distdir, max_jobs, mirrors=[], quiet=False):
+        assert max_jobs > 0
+
+        self._distdir = distdir
+        self._maxJobs = max_jobs
+        self._mirrors = list(mirrors)
+        self._quiet = quiet
+        self._fileDict = dict()             # dict<filename, (uri-list, size, dict<hash-name, hash-value>)>
+
+    def add_file(self, filename, uris, size=None, hashes={}):
+        assert "/" not in filename
+
+        if filename in self._fileDict:
+            # same file required by multiple packages, merge their URIs
+            oldUris, oldSize, oldHashes = self._fileDict[filename]
+            uris = oldUris + [x for x in uris if x not in oldUris]
+            size = oldSize if oldSize is not None else size
+            hashes = dict(hashes, **oldHashes)
+        self._fileDict[filename] = (list(uris), size, dict(hashes))
+
+    def run(self):
+        # returns dict<filename, exception-or-None>, failures are not fatal since emerge can still fetch the files itself
+        # files without size and supported hashes are skipped, they are not in the returned dict
+        ret = dict()
+        todoList = []
+        for fn, (uris, size, hashes) in self._fileDict.items():
+            if size is None and not any([k in self._HASH_FUNCS for k in hashes]):
+                # a file that can't be verified is left to emerge
+                continue
+            if self._verify(os.path.join(self._distdir, fn), size, hashes):
+                ret[fn] = None
+            else:
+                todoList.append(fn)
+        if len(todoList) == 0:
+            return ret
+
+        os.makedirs(self._getLockDir(), exist_ok=True)
+        if not self._quiet:
+            print("Prefetch %d distfiles" % (len(todoList)))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self._maxJobs, len(todoList))) as executor:
+            futureDict = {executor.submit(self._fetch, fn): fn for fn in todoList}
+            for f in concurrent.futures.as_completed(futureDict):
+                fn = futureDict[f]
+                ret[fn] = f.exception()
+                if not self._quiet and ret[fn] is not None:
+                    print("Prefetch %s failed: %s" % (fn, ret[fn]))
+
+        return ret
+
+    def _fetch(self, filename):
+        uris, size, hashes = self._fileDict[filename]
+        uris = ["%s/%s" % (x.rstrip("/"), filename) for x in self._mirrors] + uris
+        fullfn = os.path.join(self._distdir, filename)
+        tmpfn = fullfn + ".__download__"
+        lockfn = os.path.join(self._getLockDir(), filename)
+
+        with FileLock(lockfn):
+            try:
+                self._fetchLocked(filename, uris, size, hashes, fullfn, tmpfn)
+            finally:
+                # lock files don't pile up, the ones waiting for the lock retry with a new lock file, see FileLock
+                os.unlink(lockfn)
+
+    def _fetchLocked(self, filename, uris, size, hashes, fullfn, tmpfn):
+        # another build may have downloaded it while we are waiting for the lock
+        if self._verify(fullfn, size, hashes):
+            return
+
+        lastError = None
+        for uri in uris:
+            try:
+                tm = time.monotonic()
+                with urllib.request.urlopen(uri, timeout=60) as resp, open(tmpfn, "wb") as f:
+                    while True:
+                        buf = resp.read(1024 * 1024)
+                        if len(buf) == 0:
+                            break
+                        f.write(buf)
+                if not self._verify(tmpfn, size, hashes):
+                    raise ValueError("verification failed for %s" % (uri))
+                os.rename(tmpfn, fullfn)
+                if not self._quiet:
+                    print("Prefetch %s finished (%.1fs)" % (filename, time.monotonic() - tm))
+                return
+            except Exception as e:
+                lastError = e
+            finally:
+                if os.path.exists(tmpfn):
+                    os.unlink(tmpfn)
+        if lastError is None:
+            raise ValueError("no URI available")
+        raise lastError
+
+    def _verify(self, path, size, hashes):
+        # a file can't be regarded as verified if there's nothing to check
+        if not os.path.exists(path):
+            return False
+        if size is None and not any([k in self._HASH_FUNCS for k in hashes]):
+            return False
+        if size is not None and os.path.getsize(path) != size:
+            return False
+
+        hashObjDict = {k: self._HASH_FUNCS[k]() for k in hashes if k in self._HASH_FUNCS}
+        if len(hashObjDict) > 0:
+            with open(path, "rb") as f:
+                while True:
+                    buf = f.read(1024 * 1024)
+                    if len(buf) == 0:
+                        break
+                    for h in hashObjDict.values():
+                        h.update(buf)
+            for k, h in hashObjDict.items():
+                if h.hexdigest() != hashes[k].lower():
+                    return False
+        return True
+
+    def _getLockDir(self):
+        return os.path.join(self._distdir, ".gstage4-locks")
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import re
+import threading
+import traceback
+import contextvars
+from ._profiler import Profiler
+
+
+class EmergeEvent:
+
+    """Progress event of one package, parsed from emerge.log"""
+
+    START = "start"
+    MERGE = "merge"
+    FINISH = "finish"
+    FAIL = "fail"
+
+    def __init__(self, type, package, index, total, time, duration=None):
+        self.type = type                        # START, MERGE, FINISH, FAIL
+        self.package = package                  # "category/name-version"
+        self.index = index                      # "x" in "(x of y)", None for FAIL
+        self.total = total                      # "y" in "(x of y)", None for FAIL
+        self.time = time                        # seconds since epoch, in resolution of one second
+        self.duration = duration                # seconds since START, for FINISH and FAIL
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class EmergeLogWatcher:
+
+    """
+    Follows emerge.log in a thread and calls callback with EmergeEvent objects.
+    Only the lines appended after start() are parsed, the file needs not exist when start() is called.
+    Packages are also recorded as ProfileSpan of "emerge" category if a Profiler is activated when start() is called.
+    """
+
+    _INTERVAL = 0.5
+
+    _reStart = re.compile(r"(\d+):  >>> emerge \((\d+) of (\d+)\) (\S+) to \S+")
+    _reMerge = re.compile(r"(\d+):  === \((\d+) of (\d+)\) Merging(?: Binary)? \((\S+?)::")
+    _reFinish = re.compile(r"(\d+):  ::: completed emerge \((\d+) of (\d+)\) (\S+) to \S+")
+    _reEnd = re.compile(r"(\d+):  \*\*\* (exiting unsuccessfully|terminating)")
+
+    def __init__(self, path, callback):
+        self._path = path
+        self._callback = callback
+        self._thread = None
+        self._stopEvent = threading.Event()
+        self._offset = None
+        self._partial = ""
+        self._pendingDict = dict()              # dict<package, start-time>
+
+    def start(self):
+        assert self._thread is None
+
+        self._offset = os.path.getsize(self._path) if os.path.exists(self._path) else 0
+        self._stopEvent.clear()
+        ctx = contextvars.copy_context()
+        self._thread = threading.Thread(target=ctx.run, args=(self._run,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # the lines written before stop() are all parsed
+        if self._thread is not None:
+            self._stopEvent.set()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def _run(self):
+        while True:
+            stopping = self._stopEvent.wait(self._INTERVAL)
+            self._readNewLines()
+            if stopping:
+                break
+
+    def _readNewLines(self):
+        if not os.path.exists(self._path):
+            return
+        if os.path.getsize(self._path) < self._offset:
+            # the file is truncated or rotated
+            self._offset = 0
+            self._partial = ""
+
+        with open(self._path, "r", errors="replace") as f:
+            f.seek(self._offset)
+            buf = f.read()
+            self._offset = f.tell()
+
+        lineList = (self._partial + buf).split("\n")
+        self._partial = lineList.pop()
+        for line in lineList:
+            self._parseLine(line)
+
+    def _parseLine(self, line):
+        m = self._reStart.fullmatch(line)
+        if m is not None:
+            tm, pkg = int(m.group(1)), m.group(4)
+            self._pendingDict[pkg] = tm
+            self._emit(EmergeEvent(EmergeEvent.START, pkg, int(m.group(2)), int(m.group(3)), tm))
+            return
+
+        m = self._reMerge.match(line)
+        if m is not None:
+            self._emit(EmergeEvent(EmergeEvent.MERGE, m.group(4), int(m.group(2)), int(m.group(3)), int(m.group(1))))
+            return
+
+        m = self._reFinish.fullmatch(line)
+        if m is not None:
+            tm, pkg = int(m.group(1)), m.group(4)
+            startTime = self._pendingDict.pop(pkg, tm)
+            self._emit(EmergeEvent(EmergeEvent.FINISH, pkg, int(m.group(2)), int(m.group(3)), tm, tm - startTime))
+            Profiler.add_span(pkg, "emerge", startTime, tm - startTime)
+            return
+
+        m = self._reEnd.match(line)
+        if m is not None:
+            # emerge.log has no record for failed package, the ones started but not completed are failed
+            tm = int(m.group(1))
+            for pkg, startTime in sorted(self._pendingDict.items(), key=lambda x: x[1]):
+                self._emit(EmergeEvent(EmergeEvent.FAIL, pkg, None, None, tm, tm - startTime))
+                Profiler.add_span(pkg, "emerge", startTime, tm - startTime, failed=True)
+            self._pendingDict = dict()
+            return
+
+    def _emit(self, event):
+        # an exception in callback would stop the watcher thread silently, so it is printed and ignored
+        if self._callback is not None:
+            try:
+                self._callback(event)
+            except Exception:
+                print("Emerge event callback failed for %s %s:" % (event.type, event.package))
+                traceback.print_exc()
@@ -31,3 +31,14 @@ class SeedStageError(Exception):
 
 class WorkDirError(Exception):
     pass
+
+
+class RepositoryError(Exception):
+    pass
+
+
+class SyncError(Exception):
+
+    def __init__(self, message, results=None):
+        super().__init__(message)
+        self.results = results      # dict<repo-name, (elapsed-seconds, exception-or-None)>
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import re
+import bisect
+import select
+import threading
+
+
+class MountEntry:
+
+    def __init__(self, mount_id, parent_id, root, mountpoint, options, fstype, source):
+        self.mount_id = mount_id
+        self.parent_id = parent_id
+        self.root = root
+        self.mountpoint = mountpoint
+        self.options = options
+        self.fstype = fstype
+        self.source = source
+
+
+class MountTable:
+
+    """
+    Indexed view of /proc/thread-self/mountinfo.
+    The file is parsed only when kernel reports a change of the mount table (by polling mountinfo), or when the calling thread
+    has entered another mount namespace, so most queries are dictionary lookups.
+    """
+
+    _MOUNTINFO_FILE = "/proc/thread-self/mountinfo"
+
+    _MNTNS_FILE = "/proc/thread-self/ns/mnt"
+
+    _local = threading.local()
+
+    @classmethod
+    def get_thread_instance(cls):
+        # mount namespace is a per-thread attribute, so is the instance
+        if not hasattr(cls._local, "instance"):
+            cls._local.instance = cls()
+        return cls._local.instance
+
+    @classmethod
+    def close_thread_instance(cls):
+        # releases the file descriptor of the instance, it is reopened when the instance is used again
+        if hasattr(cls._local, "instance"):
+            cls._local.instance.close()
+
+    def __init__(self):
+        self._f = None
+        self._poll = None
+        self._nsIno = None
+        self._entryDict = dict()            # dict<mountpoint, MountEntry>, only the top-most mount is recorded
+        self._sortedMountPoints = []
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+            self._poll = None
+
+    def is_mount(self, path):
+        self._refresh()
+        return self._normPath(path) in self._entryDict
+
+    def get_entry(self, path):
+        self._refresh()
+        return self._entryDict.get(self._normPath(path))
+
+    def get_mount_points(self):
+        self._refresh()
+        return list(self._sortedMountPoints)
+
+    def get_mount_points_under(self, path, include_self=True):
+        self._refresh()
+
+        path = self._normPath(path)
+        ret = []
+        if include_self and path in self._entryDict:
+            ret.append(path)
+
+        prefix = path.rstrip("/") + "/"
+        i = bisect.bisect_left(self._sortedMountPoints, prefix)
+        while i < len(self._sortedMountPoints) and self._sortedMountPoints[i].startswith(prefix):
+            ret.append(self._sortedMountPoints[i])
+            i += 1
+        return ret
+
+    def _refresh(self):
+        nsIno = os.stat(self._MNTNS_FILE).st_ino
+        if self._f is not None and nsIno == self._nsIno:
+            # mountinfo raises POLLPRI|POLLERR after the mount table is changed
+            if len(self._poll.poll(0)) == 0:
+                return
+        else:
+            self.close()
+            self._f = open(self._MOUNTINFO_FILE, "r")
+            self._poll = select.poll()
+            self._poll.register(self._f, select.POLLPRI | select.POLLERR)
+            self._nsIno = nsIno
+
+        self._f.seek(0)
+        self._parse(self._f.read())
+
+    def _parse(self, buf):
+        entryDict = dict()
+        for line in buf.split("\n"):
+            if line == "":
+                continue
+            left, right = line.split(" - ", 1)
+            left = left.split(" ")
+            right = right.split(" ")
+            e = MountEntry(int(left[0]), int(left[1]), self._unescape(left[3]), self._unescape(left[4]), left[5],
+                           right[0], self._unescape(right[1]))
+            entryDict[e.mountpoint] = e                 # lines are in mount order, later one is on top
+
+        self._entryDict = entryDict
+        self._sortedMountPoints = sorted(entryDict.keys())
+
+    @staticmethod
+    def _unescape(s):
+        return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), s)
+
+    @staticmethod
+    def _normPath(path):
+        return os.path.realpath(path)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import re
+import time
+import signal
+import threading
+import contextvars
+from ._profiler import Profiler
+
+
+class PressureController:
+
+    """
+    Watches PSI (pressure stall information) and available memory in a thread while emerge is running parallel jobs.
+    When memory is running out, the youngest running job is paused with SIGSTOP on its whole process tree, so that the
+    older jobs can finish without being OOM-killed. Paused jobs are resumed with SIGCONT, oldest first, when memory is
+    available again and CPU and IO are not saturated. At least one job is always kept running.
+    Jobs are the process trees of the ebuild phases of packages in chroot_dir, if cgroup is specified its memory limit
+    and pressure are also watched.
+    Paused periods are recorded as ProfileSpan of "pressure" category if a Profiler is activated when start() is called.
+    """
+
+    _INTERVAL = 1.0
+    _COOLDOWN = 10.0                    # PSI averages lag behind, wait for the effect of the last action
+
+    _MEMORY_LOW = 0.10                  # pause a job when available memory ratio is below it
+    _MEMORY_CRITICAL = 0.05             # pause a job even in cooldown
+    _MEMORY_FULL_HIGH = 10.0            # pause a job when "full" memory pressure (%) is above it
+    _MEMORY_RESUME = 0.25               # resume a job only when available memory ratio is above it
+    _MEMORY_SOME_RESUME = 5.0           # and "some" memory pressure (%) is below it
+    _CPU_SOME_RESUME = 50.0             # and "some" CPU pressure (%) is below it
+    _IO_FULL_RESUME = 20.0              # and "full" IO pressure (%) is below it
+
+    def __init__(self, chroot_dir, cgroup=None, quiet=False):
+        self._chrootDir = os.path.realpath(chroot_dir)
+        self._cgroup = cgroup
+        self._quiet = quiet
+        self._thread = None
+        self._stopEvent = threading.Event()
+        self._lock = threading.Lock()
+        self._pausedDict = dict()               # dict<pid, (package, job-start-time, pause-time)>
+        self._lastActionTime = 0
+
+    def start(self):
+        assert self._thread is None
+
+        self._stopEvent.clear()
+        ctx = contextvars.copy_context()
+        self._thread = threading.Thread(target=ctx.run, args=(self._run,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # all the paused jobs are resumed
+        if self._thread is not None:
+            self._stopEvent.set()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def get_paused_packages(self):
+        with self._lock:
+            return [x[0] for x in self._pausedDict.values()]
+
+    def _run(self):
+        try:
+            while not self._stopEvent.wait(self._INTERVAL):
+                self._control()
+        finally:
+            procDict = _scanProcesses(self._chrootDir, self._cgroup)
+            for pid in list(self._pausedDict):
+                self._resume(procDict, pid, "finished")
+
+    def _control(self):
+        procDict = _scanProcesses(self._chrootDir, self._cgroup)
+        jobDict = _findJobs(procDict)
+
+        # forget jobs which are gone
+        with self._lock:
+            for pid in [x for x in self._pausedDict if x not in jobDict]:
+                del self._pausedDict[pid]
+
+        running = sorted([x for x in jobDict if x not in self._pausedDict], key=lambda x: jobDict[x][1])
+        if len(running) == 0 and len(self._pausedDict) > 0:
+            # the running jobs have finished, at least one job must be running regardless of the pressure, or emerge
+            # would wait forever
+            pid = min(self._pausedDict, key=lambda x: self._pausedDict[x][1])
+            self._resume(procDict, pid, "no other job is running")
+            return
+
+        memRatio, memSome, memFull = self._readMemory()
+        cpuSome = self._readPressure("cpu")[0]
+        ioFull = self._readPressure("io")[1]
+        inCooldown = time.monotonic() - self._lastActionTime < self._COOLDOWN
+
+        if memRatio < self._MEMORY_CRITICAL or (not inCooldown and (memRatio < self._MEMORY_LOW or memFull > self._MEMORY_FULL_HIGH)):
+            if len(running) > 1:
+                pid = running[-1]
+                self._pause(procDict, pid, jobDict[pid], "available memory %d%%, memory pressure %.1f%%" % (memRatio * 100, memFull))
+            return
+
+        if len(self._pausedDict) > 0 and not inCooldown:
+            if memRatio > self._MEMORY_RESUME and memSome < self._MEMORY_SOME_RESUME and cpuSome < self._CPU_SOME_RESUME and ioFull < self._IO_FULL_RESUME:
+                pid = min(self._pausedDict, key=lambda x: self._pausedDict[x][1])
+                self._resume(procDict, pid, "available memory %d%%" % (memRatio * 100))
+
+    def _pause(self, procDict, pid, job, reason):
+        self._signalTree(procDict, pid, signal.SIGSTOP)
+        with self._lock:
+            self._pausedDict[pid] = (job[0], job[1], time.time())
+        self._lastActionTime = time.monotonic()
+        if not self._quiet:
+            print("Pause building %s, %s" % (job[0], reason))
+
+    def _resume(self, procDict, pid, reason):
+        self._signalTree(procDict, pid, signal.SIGCONT)
+        with self._lock:
+            package, startTime, pauseTime = self._pausedDict.pop(pid)
+        self._lastActionTime = time.monotonic()
+        Profiler.add_span(package, "pressure", pauseTime, time.time() - pauseTime, reason=reason)
+        if not self._quiet:
+            print("Resume building %s, %s" % (package, reason))
+
+    def _signalTree(self, procDict, pid, sig):
+        # stop parents first so that they can't spawn new children, continue children first for the same reason
+        pidList = _getProcessTree(procDict, pid)
+        if sig == signal.SIGCONT:
+            pidList.reverse()
+        for p in pidList:
+            try:
+                os.kill(p, sig)
+            except ProcessLookupError:
+                pass
+
+    def _readMemory(self):
+        # returns (available-memory-ratio, some-memory-pressure, full-memory-pressure), the worse of host and cgroup
+        info = dict()
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                k, v = line.split(":", 1)
+                info[k] = int(v.split()[0])
+        ratio = info["MemAvailable"] / info["MemTotal"]
+        some, full = self._readPressure("memory")
+
+        cgPath = self._cgroup.path if self._cgroup is not None else None
+        if cgPath is not None and os.path.exists(os.path.join(cgPath, "memory.max")):
+            try:
+                with open(os.path.join(cgPath, "memory.max"), "r") as f:
+                    limit = f.read().strip()
+                if limit != "max":
+                    with open(os.path.join(cgPath, "memory.current"), "r") as f:
+                        current = int(f.read())
+                    with open(os.path.join(cgPath, "memory.stat"), "r") as f:
+                        stat = dict([x.split() for x in f.read().split("\n") if x != ""])
+                    # inactive page cache can be reclaimed without stalling
+                    ratio = min(ratio, (int(limit) - current + int(stat.get("inactive_file", 0))) / int(limit))
+                cgSome, cgFull = self._readPressureFile(os.path.join(cgPath, "memory.pressure"))
+                some, full = max(some, cgSome), max(full, cgFull)
+            except OSError:
+                # cgroup is being destroyed
+                pass
+
+        return (ratio, some, full)
+
+    def _readPressure(self, resource):
+        return self._readPressureFile(os.path.join("/proc", "pressure", resource))
+
+    @staticmethod
+    def _readPressureFile(path):
+        # returns (some-avg10, full-avg10) in percent, PSI may be disabled in kernel
+        ret = [0.0, 0.0]
+        try:
+            with open(path, "r") as f:
+                for line in f:
+                    m = re.match(r"(some|full) avg10=([0-9.]+)", line)
+                    if m is not None:
+                        ret[0 if m.group(1) == "some" else 1] = float(m.group(2))
+        except OSError:
+            pass
+        return tuple(ret)
+
+
+class BuildUsageMonitor:
+
+    """
+    Samples the resource usage of the packages being built in chroot_dir in a thread, so that it can be recorded with
+    their build time. For each package it keeps the peak RSS of its largest process, the same measure as ru_maxrss of
+    rusage, and the peak disk usage of its build directory (PORTAGE_BUILDDIR).
+    Portage reaps the ebuild phases itself, so their rusage is never seen by us, the peak RSS is read from VmHWM of the
+    processes instead. Processes living shorter than the sampling interval are missed.
+    """
+
+    _INTERVAL = 2.0
+    _DISK_INTERVAL = 30.0               # walking a big build directory is expensive
+
+    def __init__(self, chroot_dir, cgroup=None):
+        self._chrootDir = os.path.realpath(chroot_dir)
+        self._cgroup = cgroup
+        self._thread = None
+        self._stopEvent = threading.Event()
+        self._lock = threading.Lock()
+        self._usageDict = dict()                # dict<package, [peak-rss, disk-usage, build-dir-in-chroot, last-disk-check-time]>
+
+    def start(self):
+        assert self._thread is None
+
+        self._stopEvent.clear()
+        ctx = contextvars.copy_context()
+        self._thread = threading.Thread(target=ctx.run, args=(self._run,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopEvent.set()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def pop_usage(self, package):
+        # returns (peak-rss, disk-usage) in bytes of package ("category/pf"), None for the ones never sampled
+        with self._lock:
+            usage = self._usageDict.pop(package, None)
+        if usage is None:
+            return (None, None)
+        return (usage[0], usage[1])
+
+    def _run(self):
+        while not self._stopEvent.wait(self._INTERVAL):
+            self._sample()
+
+    def _sample(self):
+        procDict = _scanProcesses(self._chrootDir, self._cgroup)
+        for pid, (package, startTime) in _findJobs(procDict).items():
+            peakRss = None
+            for p in _getProcessTree(procDict, pid):
+                hwm = self._readPeakRss(p)
+                if hwm is not None and (peakRss is None or hwm > peakRss):
+                    peakRss = hwm
+
+            with self._lock:
+                if package not in self._usageDict:
+                    self._usageDict[package] = [None, None, self._readBuildDir(pid), 0]
+                usage = self._usageDict[package]
+                if peakRss is not None and (usage[0] is None or peakRss > usage[0]):
+                    usage[0] = peakRss
+                if usage[2] is None or time.monotonic() - usage[3] < self._DISK_INTERVAL:
+                    continue
+                usage[3] = time.monotonic()
+
+            # build directory may be in a tmpfs which is only visible in the mount namespace of the processes
+            diskUsage = self._readDiskUsage(os.path.join("/proc", str(pid), "root", usage[2].lstrip("/")))
+            with self._lock:
+                if usage[1] is None or diskUsage > usage[1]:
+                    usage[1] = diskUsage
+
+    @staticmethod
+    def _readPeakRss(pid):
+        # returns VmHWM of the process in bytes, None for kernel threads or if the process is gone
+        try:
+            with open("/proc/%d/status" % (pid), "r") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    @staticmethod
+    def _readBuildDir(pid):
+        # returns PORTAGE_BUILDDIR (in chroot) of an ebuild phase process, None if it is not accessible
+        try:
+            with open("/proc/%d/environ" % (pid), "rb") as f:
+                for item in f.read().split(b"\0"):
+                    if item.startswith(b"PORTAGE_BUILDDIR="):
+                        return item.decode("utf-8", errors="replace").split("=", 1)[1]
+        except OSError:
+            pass
+        return None
+
+    @staticmethod
+    def _readDiskUsage(path):
+        # returns allocated size of the files in path in bytes, files removed during the walk are ignored
+        ret = 0
+        dirList = [path]
+        while len(dirList) > 0:
+            try:
+                it = os.scandir(dirList.pop())
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    try:
+                        ret += entry.stat(follow_symlinks=False).st_blocks * 512
+                        if entry.is_dir(follow_symlinks=False):
+                            dirList.append(entry.path)
+                    except OSError:
+                        pass
+        return ret
+
+
+_reJobTitle = re.compile(r"\[([^\s\]]+/[^\s\]]+)\] .*")         # portage sets process title of ebuild phases as "[category/pf] sandbox ..."
+
+
+def _scanProcesses(chrootDir, cgroup):
+    # returns dict<pid, (ppid, start-time-in-ticks, first-argument)> of processes in chroot directory
+    pidSet = None
+    if cgroup is not None and cgroup.path is not None:
+        pidSet = set(cgroup.get_pids())
+
+    ret = dict()
+    for fn in os.listdir("/proc"):
+        if not fn.isdigit() or (pidSet is not None and int(fn) not in pidSet):
+            continue
+        try:
+            if os.readlink("/proc/%s/root" % (fn)) != chrootDir:
+                continue
+            with open("/proc/%s/stat" % (fn), "r") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open("/proc/%s/cmdline" % (fn), "rb") as f:
+                arg0 = f.read().split(b"\0")[0].decode("utf-8", errors="replace")
+        except OSError:
+            # process is gone, or is not accessible
+            continue
+        ret[int(fn)] = (int(fields[1]), int(fields[19]), arg0)
+    return ret
+
+
+def _findJobs(procDict):
+    # returns dict<pid, (package, start-time-in-ticks)> of the top-most processes of ebuild phases
+    ret = dict()
+    for pid, (ppid, startTime, arg0) in procDict.items():
+        m = _reJobTitle.fullmatch(arg0)
+        if m is None:
+            continue
+        p = ppid
+        while p in procDict and _reJobTitle.fullmatch(procDict[p][2]) is None:
+            p = procDict[p][0]
+        if p not in procDict:
+            ret[pid] = (m.group(1), startTime)
+    return ret
+
+
+def _getProcessTree(procDict, pid):
+    # returns list<pid> of the process and its descendants, parents before children
+    ret = [pid]
+    i = 0
+    while i < len(ret):
+        ret += [k for k, v in procDict.items() if v[0] == ret[i]]
+        i += 1
+    return ret
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import json
+import time
+import asyncio
+import threading
+import contextlib
+import contextvars
+
+
+class ProfileSpan:
+
+    """Timing of one phase of a build"""
+
+    def __init__(self, name, category, start_time, duration, thread_id, args):
+        self.name = name
+        self.category = category                # "step", "workdir", "mount", "script", "emerge", ...
+        self.start_time = start_time            # seconds since epoch
+        self.duration = duration                # seconds
+        self.thread_id = thread_id              # see Profiler.get_thread_id()
+        self.args = args                        # dict, extra information
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class Profiler:
+
+    """
+    Collects timing spans of the phases of a build while it is activated, spans can be nested.
+    Like ResourceAccounting, activation is bound to the current context.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = []
+
+    @contextlib.contextmanager
+    def activate(self):
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def get_spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def write_report(self, path, command_records=[]):
+        # command_records is list<CommandRecord>, they are included in the report
+        data = {
+            "spans": [x.to_dict() for x in self.get_spans()],
+            "commands": [x.to_dict() for x in command_records],
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, indent=4)
+
+    def write_chrome_trace(self, path, command_records=[]):
+        # writes in trace event format, which can be loaded by chrome://tracing or perfetto
+        spanList = self.get_spans()
+        tidDict = dict()
+        eventList = []
+
+        def __event(name, cat, startTime, duration, threadId, args):
+            if threadId not in tidDict:
+                tidDict[threadId] = len(tidDict) + 1
+            eventList.append({
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": int(startTime * 1000000),
+                "dur": int(duration * 1000000),
+                "pid": 1,
+                "tid": tidDict[threadId],
+                "args": args,
+            })
+
+        for s in spanList:
+            __event(s.name, s.category, s.start_time, s.duration, s.thread_id, s.args)
+        for r in command_records:
+            args = {k: v for k, v in r.to_dict().items() if k not in ["start_time", "wall_time", "thread_id"]}
+            args["cmd"] = str(args["cmd"])
+            __event(r.description if r.description is not None else str(r.cmd), "command", r.start_time, r.wall_time, r.thread_id, args)
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": eventList, "displayTimeUnit": "ms"}, f)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name, category, **kwargs):
+        p = _current.get()
+        if p is None:
+            yield
+            return
+
+        startTime = time.time()
+        tm = time.monotonic()
+        try:
+            yield
+        finally:
+            p._append(ProfileSpan(name, category, startTime, time.monotonic() - tm, Profiler.get_thread_id(), kwargs))
+
+    @staticmethod
+    def add_span(name, category, start_time, duration, **kwargs):
+        # add a span measured by other means, such as the ones parsed from log files
+        p = _current.get()
+        if p is not None:
+            p._append(ProfileSpan(name, category, start_time, duration, Profiler.get_thread_id(), kwargs))
+
+    @staticmethod
+    def get_thread_id():
+        # concurrent commands of AsyncRunner run in one thread, so each asyncio task is regarded as a thread
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        return threading.get_ident() if task is None else "task-%d" % (id(task))
+
+    def _append(self, span):
+        with self._lock:
+            self._spans.append(span)
+
+
+_current = contextvars.ContextVar("gstage4_profiler", default=None)
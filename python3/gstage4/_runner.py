@@ -22,16 +22,46 @@
 
 
 import os
+import re
+import sys
+import time
+import uuid
+import shlex
+import errno
+import signal
+import shutil
+import asyncio
 import platform
+import threading
+import contextlib
+import subprocess
+import collections
 import robust_layer.simple_fops
 from ._util import Util
+from ._util import OutputCapture
+from ._accounting import ResourceAccounting
+from ._accounting import CommandTimer
+from ._profiler import Profiler
+from ._util import MS_BIND
+from ._util import MS_REC
+from ._util import MS_SLAVE
+from ._util import MNT_DETACH
+from ._util import NewMountNamespace
+from ._mounttable import MountTable
 
 
 class Runner:
 
-    def __init__(self, chroot_dir_path):
+    def __init__(self, chroot_dir_path, private_mount_namespace=True, persistent_executor=False, cgroup=None):
         self._dir = chroot_dir_path
+        self._privateMntNs = private_mount_namespace
+        self._mntNs = None
+        self._cgroup = cgroup                       # CGroup object, it is created in bind() and destroyed in unbind()
+        self._usePersistentExecutor = persistent_executor      # commands have stdin redirected from /dev/null when using it, see _ChrootExecutor
+        self._executor = None
+        self._executorLock = threading.Lock()
         self._mountList = []
+        self._mountTable = None
         self._scriptDirList = []
 
     def __enter__(self):
@@ -45,42 +75,45 @@ class Runner:
     def binded(self):
         return len(self._mountList) > 0
 
+    @property
+    def cgroup(self):
+        return self._cgroup
+
     def bind(self):
         assert len(self._mountList) == 0
 
         try:
+            # all the processes are spawned in the cgroup, so that they are confined and can be killed at once
+            if self._cgroup is not None:
+                self._cgroup.create()
+
+            # all the mounts are done in a private mount namespace, so they never leak to the host
+            if self._privateMntNs:
+                mntNs = NewMountNamespace()
+                mntNs.open()
+                self._mntNs = mntNs
+
+            # mount table is parsed only when it is changed, it is the one of the mount namespace
+            self._mountTable = self._inMntNs(MountTable.get_thread_instance)
+
             # copy resolv.conf
             # FIMXE: can not adapt the network cfg of host system change
-            Util.shellCall("cp -L /etc/resolv.conf \"%s\"" % (os.path.join(self._dir, "etc")))
+            shutil.copyfile("/etc/resolv.conf", os.path.join(self._dir, "etc", "resolv.conf"))
 
             # mount /proc
-            fullfn = os.path.join(self._dir, "proc")
-            assert os.path.exists(fullfn) and not Util.isMount(fullfn)
-            Util.shellCall("mount -t proc proc \"%s\"" % (fullfn))
-            self._mountList.append(fullfn)
+            self._mount(os.path.join(self._dir, "proc"), "proc", "proc", 0)
 
             # mount /sys
-            fullfn = os.path.join(self._dir, "sys")
-            assert os.path.exists(fullfn) and not Util.isMount(fullfn)
-            Util.shellCall("mount --rbind /sys \"%s\"" % (fullfn))
-            Util.shellCall("mount --make-rslave \"%s\"" % (fullfn))
-            self._mountList.append(fullfn)
+            self._mount(os.path.join(self._dir, "sys"), "/sys", None, MS_BIND | MS_REC, slave=True)
 
             # mount /dev
-            fullfn = os.path.join(self._dir, "dev")
-            assert os.path.exists(fullfn) and not Util.isMount(fullfn)
-            Util.shellCall("mount --rbind /dev \"%s\"" % (fullfn))
-            Util.shellCall("mount --make-rslave \"%s\"" % (fullfn))
-            self._mountList.append(fullfn)
+            self._mount(os.path.join(self._dir, "dev"), "/dev", None, MS_BIND | MS_REC, slave=True)
 
             # FIXME: mount /run
             pass
 
             # mount /tmp
-            fullfn = os.path.join(self._dir, "tmp")
-            assert os.path.exists(fullfn) and not Util.isMount(fullfn)
-            Util.shellCall("mount -t tmpfs tmpfs \"%s\"" % (fullfn))
-            self._mountList.append(fullfn)
+            self._mount(os.path.join(self._dir, "tmp"), "tmpfs", "tmpfs", 0)
         except BaseException:
             self._unbind(False)
             raise
@@ -93,61 +126,112 @@ class Runner:
         assert len(self._mountList) > 0
 
         cmd = "bash"       # FIXME: change to read shell
-        return Util.shellExec("chroot \"%s\" %s" % (self._dir, cmd))
+        return Util.shellExec("chroot \"%s\" %s" % (self._dir, cmd), preexec_fn=self._getPreexecFn())
 
     def shell_call(self, env, cmd):
         # "CLEAN_DELAY=0 emerge -C sys-fs/eudev" -> "CLEAN_DELAY=0 chroot emerge -C sys-fs/eudev"
         assert len(self._mountList) > 0
+        assert self._detectArch() == platform.machine()
+
+        with self._acquireExecutor() as executor:
+            if executor is not None:
+                return executor.call(env, cmd)
 
         # FIXME
         env = "LANG=C.utf8 PATH=/bin:/usr/bin:/sbin:/usr/sbin " + env
-        assert self._detectArch() == platform.machine()
 
-        return Util.shellCall("%s chroot \"%s\" %s" % (env, self._dir, cmd))
+        return Util.shellCall("%s chroot \"%s\" %s" % (env, self._dir, cmd), preexec_fn=self._getPreexecFn())
 
     def shell_test(self, env, cmd):
         assert len(self._mountList) > 0
+        assert self._detectArch() == platform.machine()
+
+        with self._acquireExecutor() as executor:
+            if executor is not None:
+                return executor.test(env, cmd)
 
         # FIXME
         env = "LANG=C.utf8 PATH=/bin:/usr/bin:/sbin:/usr/sbin " + env
-        assert self._detectArch() == platform.machine()
 
-        return Util.shellCallTestSuccess("%s chroot \"%s\" %s" % (env, self._dir, cmd))
+        return Util.shellCallTestSuccess("%s chroot \"%s\" %s" % (env, self._dir, cmd), preexec_fn=self._getPreexecFn())
 
     def shell_exec(self, env, cmd, quiet=False):
         assert len(self._mountList) > 0
+        assert self._detectArch() == platform.machine()
+
+        with self._acquireExecutor() as executor:
+            if executor is not None:
+                if not quiet:
+                    executor.exec(env, cmd)
+                else:
+                    executor.call(env, cmd, capture=False)
+                return
 
         # FIXME
         env = "LANG=C.utf8 PATH=/bin:/usr/bin:/sbin:/usr/sbin " + env
-        assert self._detectArch() == platform.machine()
 
         if not quiet:
-            Util.shellExec("%s chroot \"%s\" %s" % (env, self._dir, cmd))
+            Util.shellExec("%s chroot \"%s\" %s" % (env, self._dir, cmd), preexec_fn=self._getPreexecFn())
         else:
-            Util.shellCall("%s chroot \"%s\" %s" % (env, self._dir, cmd))
+            # output is not needed, keep only its tail for error reporting
+            Util.shellCall("%s chroot \"%s\" %s" % (env, self._dir, cmd), capture=False, preexec_fn=self._getPreexecFn())
 
     def script_exec(self, scriptObj, quiet=False):
         assert len(self._mountList) > 0
 
-        path = os.path.join("/var", "tmp", "script_%d" % (len(self._scriptDirList)))
-        hostPath = os.path.join(self._dir, path[1:])
+        path = self._prepareScriptDir(scriptObj, quiet)
+        with ResourceAccounting.describe(scriptObj.get_description()), Profiler.span(scriptObj.get_description(), "script"):
+            self.shell_exec("", "sh -c \"cd %s ; ./%s\"" % (path, scriptObj.get_script()), quiet)
 
-        assert not os.path.exists(hostPath)
-        os.makedirs(hostPath, mode=0o755)
-        self._scriptDirList.append(hostPath)
+    def script_exec_batch(self, scriptObjList, quiet=False):
+        # executes scripts one by one in one chroot invocation, stops at the first failed script
+        # returns list<(returncode, elapsed-seconds)> of the executed scripts
+        # when failed, the list is attached to the raised exception as its "results" attribute, which is None if the list can't be read
+        assert len(self._mountList) > 0
 
-        if not quiet:
-            print(scriptObj.get_description())
-        scriptObj.fill_script_dir(hostPath)
-        self.shell_exec("", "sh -c \"cd %s ; ./%s\"" % (path, scriptObj.get_script()), quiet)
+        if len(scriptObjList) == 0:
+            return []
+
+        path, statusHostPath = self._prepareScriptBatch(scriptObjList, quiet)
+        description = "Batch of %d scripts" % (len(scriptObjList))
+        timer = CommandTimer("sh %s" % (path))
+        try:
+            # the scripts are recorded one by one from the status file, instead of the batch as a whole
+            with ResourceAccounting.suppress(), Profiler.span(description, "script"):
+                self.shell_exec("", "sh %s" % (path), quiet)
+        except BaseException as e:
+            e.results = self._finishScriptBatch(scriptObjList, statusHostPath, description, timer, getattr(e, "returncode", None), e)
+            raise
+        return self._finishScriptBatch(scriptObjList, statusHostPath, description, timer, 0, None)
 
     def _unbind(self, remove_scripts):
         assert isinstance(remove_scripts, bool)
 
-        for fullfn in reversed(self._mountList):
-            if os.path.exists(fullfn) and Util.isMount(fullfn):
-                Util.cmdCall("umount", "-l", fullfn)
-        self._mountList = []
+        if self._executor is not None:
+            self._executor.stop()
+            self._executor = None
+
+        if self._cgroup is not None:
+            # kill the remaining processes, such as daemons started in chroot, which may keep mount points busy
+            self._cgroup.destroy()
+
+        try:
+            for fullfn in reversed(self._mountList):
+                self._umount(fullfn)
+            self._mountList = []
+
+            if self._mountTable is not None:
+                # umount leaked mounts, such as the ones created by commands in chroot
+                # chroot directory itself may be a mount point, such as a btrfs subvolume, it must be kept
+                for fullfn in reversed(self._inMntNs(lambda: self._mountTable.get_mount_points_under(self._dir, include_self=False))):
+                    self._umount(fullfn)
+        finally:
+            self._mountList = []
+            self._mountTable = None
+            self._inMntNs(MountTable.close_thread_instance)
+            if self._mntNs is not None:
+                self._mntNs.close()
+                self._mntNs = None
 
         robust_layer.simple_fops.rm(os.path.join(self._dir, "etc", "resolv.conf"))
 
@@ -156,6 +240,362 @@ class Runner:
                 robust_layer.simple_fops.rm(hostPath)
         self._scriptDirList = []
 
+    def _prepareScriptDir(self, scriptObj, quiet):
+        path, hostPath = self._newScriptDir()
+        if not quiet:
+            print(scriptObj.get_description())
+        scriptObj.fill_script_dir(hostPath)
+        return path
+
+    def _prepareScriptBatch(self, scriptObjList, quiet):
+        # returns (driver-script-path, status-file-hostpath)
+        pathList = [self._prepareScriptDir(x, True) for x in scriptObjList]
+        path, hostPath = self._newScriptDir()
+        statusPath = os.path.join(path, "status")
+
+        # the driver records exit code and start/end time of each script in the status file
+        # EPOCHREALTIME is provided by bash, which is /bin/sh in most target systems, times are empty if it is not supported
+        buf = ""
+        buf += "__run() {\n"
+        buf += "    __t0=$EPOCHREALTIME\n"
+        buf += "    (cd \"$2\" && exec \"./$3\")\n"
+        buf += "    __rc=$?\n"
+        buf += "    echo \"$1 $__rc $__t0 $EPOCHREALTIME\" >> %s\n" % (statusPath)
+        buf += "    return $__rc\n"
+        buf += "}\n"
+        for i, scriptObj in enumerate(scriptObjList):
+            if not quiet:
+                buf += "echo %s\n" % (shlex.quote(scriptObj.get_description()))
+            buf += "__run %d %s %s || exit $?\n" % (i, pathList[i], shlex.quote(scriptObj.get_script()))
+        with open(os.path.join(hostPath, "driver.sh"), "w") as f:
+            f.write(buf)
+
+        return (os.path.join(path, "driver.sh"), os.path.join(hostPath, "status"))
+
+    def _finishScriptBatch(self, scriptObjList, statusHostPath, description, timer, returncode, error):
+        # returns list<(returncode, elapsed-seconds)>, or None if the status file can't be read when handling error
+        # the batch is recorded as a whole if the scripts can't be recorded one by one
+        try:
+            ret = self._readScriptBatchStatus(scriptObjList, statusHostPath)
+        except Exception as e:
+            if error is None:
+                raise
+            print("Failed to read script batch status (%s), it is ignored since the batch failed (%s)." % (e, error))
+            ret = None
+        if ret is None or len(ret) == 0 or any(x[1] is None for x in ret):
+            with ResourceAccounting.describe(description):
+                timer.finish(returncode)
+        return ret
+
+    def _readScriptBatchStatus(self, scriptObjList, statusHostPath):
+        ret = []
+        if not os.path.exists(statusHostPath):
+            return ret
+
+        with open(statusHostPath, "r") as f:
+            for line in f.read().split("\n"):
+                fields = line.split(" ")
+                if len(fields) != 4:
+                    continue
+                i, returncode = int(fields[0]), int(fields[1])
+                if fields[2] != "" and fields[3] != "":
+                    startTime = float(fields[2])
+                    elapsed = float(fields[3]) - startTime
+                    with ResourceAccounting.describe(scriptObjList[i].get_description()):
+                        ResourceAccounting.record(scriptObjList[i].get_script(), startTime, elapsed, None, returncode)
+                    Profiler.add_span(scriptObjList[i].get_description(), "script", startTime, elapsed, returncode=returncode)
+                else:
+                    elapsed = None
+                ret.append((returncode, elapsed))
+        return ret
+
+    def _newScriptDir(self):
+        path = os.path.join("/var", "tmp", "script_%d" % (len(self._scriptDirList)))
+        hostPath = os.path.join(self._dir, path[1:])
+
+        assert not os.path.exists(hostPath)
+        os.makedirs(hostPath, mode=0o755)
+        self._scriptDirList.append(hostPath)
+        return (path, hostPath)
+
+    @contextlib.contextmanager
+    def _acquireExecutor(self):
+        # returns None if persistent executor is not used, or it is busy running command for another thread
+        if not self._usePersistentExecutor or not self._executorLock.acquire(blocking=False):
+            yield None
+            return
+        try:
+            if self._executor is None or not self._executor.is_alive():
+                self._executor = _ChrootExecutor(self._dir, self._getPreexecFn())
+            yield self._executor
+        finally:
+            self._executorLock.release()
+
+    def _mount(self, fullfn, source, fstype, flags, slave=False, mountList=None, data=None):
+        def __mount():
+            assert os.path.exists(fullfn) and not self._mountTable.is_mount(fullfn)
+
+            Util.mount(source, fullfn, fstype, flags, data)
+            (mountList if mountList is not None else self._mountList).append(fullfn)
+
+            if slave:
+                # same as "mount --make-rslave"
+                Util.mount(None, fullfn, None, MS_SLAVE | MS_REC)
+
+        self._inMntNs(__mount)
+
+    def _umount(self, fullfn):
+        def __umount():
+            try:
+                Util.umount(fullfn, MNT_DETACH)
+            except OSError as e:
+                if e.errno != errno.EINVAL:        # not mounted
+                    raise
+
+        self._inMntNs(__umount)
+
+    def _inMntNs(self, func, *args):
+        # mounts and the mount table must be operated in the mount namespace, returns result of func
+        if self._mntNs is None:
+            return func(*args)
+        return self._mntNs.call(func, *args)
+
+    def _getPreexecFn(self):
+        # mount namespace is held by its own thread, all the processes enter the namespace by themselves
+        fnList = [
+            self._mntNs.enter_in_child if self._mntNs is not None else None,
+            self._cgroup.preexec_fn if self._cgroup is not None else None,
+        ]
+        fnList = [x for x in fnList if x is not None]
+        if len(fnList) <= 1:
+            return fnList[0] if len(fnList) > 0 else None
+
+        def __fn():
+            for fn in fnList:
+                fn()
+        return __fn
+
     def _detectArch(self):
         # FIXME: use profile function of pkgwh to get arch from CHOST
         return "x86_64"
+
+
+class AsyncRunner:
+
+    """
+    Chroot runner whose command execution methods are coroutines.
+    Commands can be cancelled or be given a timeout, independent commands can be executed concurrently, e.g. by asyncio.gather().
+    bind() and unbind() are synchronous, they are fast since no process is spawned.
+    Mounts, namespace and cgroup are managed by an internal Runner object, which is never used to execute commands.
+    """
+
+    def __init__(self, chroot_dir_path, private_mount_namespace=True, cgroup=None):
+        self._runner = Runner(chroot_dir_path, private_mount_namespace=private_mount_namespace, cgroup=cgroup)
+        self._dir = chroot_dir_path
+
+    def __enter__(self):
+        self.bind()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.unbind()
+
+    @property
+    def binded(self):
+        return self._runner.binded
+
+    @property
+    def cgroup(self):
+        return self._runner.cgroup
+
+    def bind(self):
+        self._runner.bind()
+
+    def unbind(self, remove_scripts=True):
+        self._runner.unbind(remove_scripts)
+
+    def interactive_shell(self):
+        assert self.binded
+
+        cmd = "bash"       # FIXME: change to read shell
+        subprocess.run(["chroot", self._dir, cmd], preexec_fn=self._runner._getPreexecFn()).check_returncode()
+
+    async def shell_call(self, env, cmd, timeout=None):
+        returncode, out = await self._shellRun(env, cmd, True, True, timeout)
+        if returncode != 0:
+            print(out)
+            raise subprocess.CalledProcessError(returncode, cmd, out)
+        return out.rstrip()
+
+    async def shell_test(self, env, cmd, timeout=None):
+        returncode, out = await self._shellRun(env, cmd, True, False, timeout)
+        return (returncode == 0)
+
+    async def shell_exec(self, env, cmd, quiet=False, timeout=None):
+        returncode, out = await self._shellRun(env, cmd, quiet, False, timeout)
+        if returncode != 0:
+            if quiet:
+                print(out)
+            raise subprocess.CalledProcessError(returncode, cmd, out)
+
+    async def script_exec(self, scriptObj, quiet=False, timeout=None):
+        assert self.binded
+
+        path = self._runner._prepareScriptDir(scriptObj, quiet)
+        with ResourceAccounting.describe(scriptObj.get_description()), Profiler.span(scriptObj.get_description(), "script"):
+            await self.shell_exec("", "sh -c \"cd %s ; ./%s\"" % (path, scriptObj.get_script()), quiet, timeout)
+
+    async def script_exec_batch(self, scriptObjList, quiet=False, timeout=None):
+        assert self.binded
+
+        if len(scriptObjList) == 0:
+            return []
+
+        path, statusHostPath = self._runner._prepareScriptBatch(scriptObjList, quiet)
+        description = "Batch of %d scripts" % (len(scriptObjList))
+        timer = CommandTimer("sh %s" % (path))
+        try:
+            with ResourceAccounting.suppress(), Profiler.span(description, "script"):
+                await self.shell_exec("", "sh %s" % (path), quiet, timeout)
+        except BaseException as e:
+            e.results = self._runner._finishScriptBatch(scriptObjList, statusHostPath, description, timer, getattr(e, "returncode", None), e)
+            raise
+        return self._runner._finishScriptBatch(scriptObjList, statusHostPath, description, timer, 0, None)
+
+    async def _shellRun(self, env, cmd, captureOutput, keepAllOutput, timeout):
+        assert self.binded
+        assert self._runner._detectArch() == platform.machine()
+
+        # FIXME
+        env = "LANG=C.utf8 PATH=/bin:/usr/bin:/sbin:/usr/sbin " + env
+
+        # a new session is used so that the whole process tree can be killed on timeout and cancellation
+        # resource usage is not available since the process is reaped by asyncio, only wall time is recorded
+        timer = CommandTimer(cmd)
+        proc = await asyncio.create_subprocess_shell("%s chroot \"%s\" %s" % (env, self._dir, cmd),
+                                                     stdout=(subprocess.PIPE if captureOutput else None),
+                                                     stderr=(subprocess.STDOUT if captureOutput else None),
+                                                     limit=1024 * 1024,
+                                                     start_new_session=True,
+                                                     preexec_fn=self._runner._getPreexecFn())
+        lines = [] if keepAllOutput else collections.deque(maxlen=OutputCapture.TAIL_LINES)
+
+        async def __wait():
+            if proc.stdout is not None:
+                async for line in proc.stdout:
+                    lines.append(line.decode("utf-8", errors="replace"))
+            return await proc.wait()
+
+        try:
+            returncode = await asyncio.wait_for(__wait(), timeout)
+        except BaseException:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+            timer.finish(proc.returncode)
+            raise
+
+        timer.finish(returncode)
+        return (returncode, "".join(lines))
+
+
+class _ChrootExecutor:
+
+    """
+    A long-lived shell in chroot which reads commands from a pipe.
+    Executing a command spawns only one process (the sub-shell), instead of host shell + chroot + target shell.
+    Standard input of commands is /dev/null, since the pipe carries the following commands. Interactive commands can't
+    be executed by it, they get EOF when reading input.
+    """
+
+    def __init__(self, chrootDir, preexecFn):
+        env = os.environ.copy()
+        env["LANG"] = "C.utf8"                                  # FIXME
+        env["PATH"] = "/bin:/usr/bin:/sbin:/usr/sbin"
+        self._proc = subprocess.Popen(["chroot", chrootDir, "/bin/sh"],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                      env=env, universal_newlines=True, bufsize=1, preexec_fn=preexecFn)
+        self._childrenTimes = (0, 0)
+
+    def is_alive(self):
+        return self._proc.poll() is None
+
+    def stop(self):
+        if self._proc.poll() is None:
+            self._proc.stdin.close()
+            try:
+                self._proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+                self._proc.wait()
+        self._proc.stdout.close()
+
+    def call(self, env, cmd, capture=True):
+        returncode, out = self._execute(env, cmd, False, capture)
+        if returncode > 128:
+            time.sleep(1.0)                     # same as Util.cmdCall()
+        if returncode != 0:
+            print(out)
+            raise subprocess.CalledProcessError(returncode, cmd, out)
+        return out.rstrip() if capture else None
+
+    def test(self, env, cmd):
+        returncode, out = self._execute(env, cmd, False, False)
+        if returncode > 128:
+            time.sleep(1.0)
+        return (returncode == 0)
+
+    def exec(self, env, cmd):
+        returncode, out = self._execute(env, cmd, True, False)
+        if returncode > 128:
+            time.sleep(1.0)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+    def _execute(self, env, cmd, printOutput, capture):
+        marker = "==gstage4-%s==" % (uuid.uuid4().hex)
+
+        # commands run in sub-shell so that they can't change the state of the executor
+        buf = "("
+        if env.strip() != "":
+            buf += "export %s; " % (env)
+        buf += "%s\n) < /dev/null 2>&1; printf '%s %%d\\n' $?; times\n" % (cmd, marker)
+        timer = CommandTimer(cmd)
+        self._proc.stdin.write(buf)
+        self._proc.stdin.flush()
+
+        lineList = [] if capture else collections.deque(maxlen=OutputCapture.TAIL_LINES)
+        while True:
+            line = self._proc.stdout.readline()
+            if line == "":
+                raise EOFError("persistent executor exited unexpectedly")
+
+            # marker is not at line start if output of the command does not end with newline
+            i = line.find(marker + " ")
+            if i >= 0:
+                returncode = int(line[i + len(marker) + 1:])
+                line = line[:i]
+
+            if printOutput:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            else:
+                lineList.append(line)
+
+            if i >= 0:
+                timer.finish(returncode, self._readChildrenTimes())
+                return (returncode, "".join(lineList))
+
+    def _readChildrenTimes(self):
+        # the sub-shell can't be waited by us, so cpu times are calculated from the output of "times", which prints
+        # the accumulated times of the shell itself in the first line and of its children in the second line
+        self._proc.stdout.readline()
+        m = re.fullmatch(r"(\d+)m([0-9.]+)s (\d+)m([0-9.]+)s", self._proc.stdout.readline().strip())
+        if m is None:
+            return None
+        cur = (int(m.group(1)) * 60 + float(m.group(2)), int(m.group(3)) * 60 + float(m.group(4)))
+        ret = (cur[0] - self._childrenTimes[0], cur[1] - self._childrenTimes[1])
+        self._childrenTimes = cur
+        return ret
@@ -23,6 +23,8 @@
 
 import os
 import re
+import json
+import hashlib
 import multiprocessing
 from ._errors import SettingsError
 
@@ -38,15 +40,51 @@ class Settings:
 
         self.host_computing_power = None
 
+        # max number of concurrent network jobs, such as syncing repositories
+        self.network_jobs = 4
+
+        # confine processes in target system in a cgroup v2 group, limits not specified are derived from host_computing_power
+        self.use_cgroup = False
+        self.cgroup_cpu_count = None
+        self.cgroup_memory_max = None           # in byte
+        self.cgroup_io_weight = None            # 1-10000
+
         # distfiles directory in host system, will be bind mounted in target system
         self.host_distfiles_dir = None
 
         # packages directory in host system
         self.host_packages_dir = None
 
+        # build binary packages into host_packages_dir and reuse them in later builds
+        # host_packages_dir is partitioned by TargetSettings.get_build_config_key(), so that incompatible packages never mix
+        self.binpkg_reuse = False
+
+        # binhosts to get binary packages from, such as the URLs of BinhostServer on other nodes
+        # the partition of host_packages_dir is appended to the URLs if binpkg_reuse is enabled
+        self.binhost_urls = []
+
+        # distcc servers to spread compilation to, dict<host-specification, job-count>, such as {"192.168.1.2": 16, "node2:3632": 8}
+        # sys-devel/distcc must be installed in target system
+        self.distcc_hosts = dict()
+
         # ccache directory in host system
         self.host_ccache_dir = None
 
+        # build time database file in host system, see BuildTimeDatabase
+        self.host_build_time_db = None
+
+        # download distfiles into host_distfiles_dir concurrently before updating @world, see DistfilePrefetcher
+        self.prefetch_distfiles = False
+        self.prefetch_mirrors = []              # list<url>, tried before the URIs of the packages
+
+        # pause and resume parallel emerge jobs by memory pressure when updating @world, see PressureController
+        self.pressure_control = False
+
+        # build packages in a tmpfs mounted on PORTAGE_TMPDIR, its size defaults to half of host memory
+        # packages too big for memory are built on disk, see TargetConfDirWriter.write_package_env()
+        self.tmpfs_portage_tmpdir = False
+        self.tmpfs_portage_tmpdir_size = None       # in byte
+
     @classmethod
     def check_object(cls, obj, raise_exception=None):
         assert raise_exception is not None
@@ -81,6 +119,36 @@ class Settings:
             else:
                 return False
 
+        if not isinstance(obj.network_jobs, int) or obj.network_jobs <= 0:
+            if raise_exception:
+                raise SettingsError("invalid value for key \"network_jobs\"")
+            else:
+                return False
+
+        if not isinstance(obj.use_cgroup, bool):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"use_cgroup\"")
+            else:
+                return False
+
+        if obj.cgroup_cpu_count is not None and (not isinstance(obj.cgroup_cpu_count, int) or obj.cgroup_cpu_count <= 0):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"cgroup_cpu_count\"")
+            else:
+                return False
+
+        if obj.cgroup_memory_max is not None and (not isinstance(obj.cgroup_memory_max, int) or obj.cgroup_memory_max <= 0):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"cgroup_memory_max\"")
+            else:
+                return False
+
+        if obj.cgroup_io_weight is not None and (not isinstance(obj.cgroup_io_weight, int) or not (1 <= obj.cgroup_io_weight <= 10000)):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"cgroup_io_weight\"")
+            else:
+                return False
+
         if obj.host_distfiles_dir is not None and not os.path.isdir(obj.host_distfiles_dir):
             if raise_exception:
                 raise SettingsError("invalid value for key \"host_distfiles_dir\"")
@@ -93,12 +161,67 @@ class Settings:
             else:
                 return False
 
+        if not isinstance(obj.binpkg_reuse, bool):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"binpkg_reuse\"")
+            else:
+                return False
+
+        if not isinstance(obj.binhost_urls, list) or not all([isinstance(x, str) for x in obj.binhost_urls]):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"binhost_urls\"")
+            else:
+                return False
+
+        if not isinstance(obj.distcc_hosts, dict) or not all([isinstance(k, str) and re.fullmatch(r"[^\s/]+", k) is not None and isinstance(v, int) and v > 0 for k, v in obj.distcc_hosts.items()]):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"distcc_hosts\"")
+            else:
+                return False
+
         if obj.host_ccache_dir is not None and not os.path.isdir(obj.host_ccache_dir):
             if raise_exception:
                 raise SettingsError("invalid value for key \"host_ccache_dir\"")
             else:
                 return False
 
+        if obj.host_build_time_db is not None and not os.path.isdir(os.path.dirname(os.path.abspath(obj.host_build_time_db))):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"host_build_time_db\"")
+            else:
+                return False
+
+        if not isinstance(obj.prefetch_distfiles, bool) or (obj.prefetch_distfiles and obj.host_distfiles_dir is None):
+            # distfiles are prefetched into host_distfiles_dir
+            if raise_exception:
+                raise SettingsError("invalid value for key \"prefetch_distfiles\"")
+            else:
+                return False
+
+        if not isinstance(obj.prefetch_mirrors, list) or not all([isinstance(x, str) for x in obj.prefetch_mirrors]):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"prefetch_mirrors\"")
+            else:
+                return False
+
+        if not isinstance(obj.pressure_control, bool):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"pressure_control\"")
+            else:
+                return False
+
+        if not isinstance(obj.tmpfs_portage_tmpdir, bool):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"tmpfs_portage_tmpdir\"")
+            else:
+                return False
+
+        if obj.tmpfs_portage_tmpdir_size is not None and (not isinstance(obj.tmpfs_portage_tmpdir_size, int) or obj.tmpfs_portage_tmpdir_size <= 0):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"tmpfs_portage_tmpdir_size\"")
+            else:
+                return False
+
         return True
 
 
@@ -240,6 +363,9 @@ class TargetSettings:
                 raise SettingsError("invalid value for \"kern_build_opts\"")
             if obj.kern_build_opts.ccache is not None:
                 raise SettingsError("invalid value for key \"ccache\" in \"kern_build_opts\"")  # ccache is only allowed in global build options
+            for key in ["cxxflags", "fcflags", "fflags"]:
+                if len(getattr(obj.kern_build_opts, key)) > 0:
+                    raise SettingsError("invalid value for key \"%s\" in \"kern_build_opts\"" % (key))    # kernel has no code in these languages
 
             if obj.pkg_build_opts is None or not isinstance(obj.pkg_build_opts, dict):
                 raise SettingsError("invalid value for \"pkg_build_opts\"")
@@ -259,6 +385,24 @@ class TargetSettings:
             else:
                 return False
 
+    def get_build_config_key(self):
+        # returns a key like "amd64-0123456789abcdef", targets with the same key build compatible binary packages
+        # USE flags of a single package are also checked by emerge --binpkg-respect-use=y when the package is reused
+        def __flags(buildOpts):
+            return [buildOpts.common_flags, buildOpts.cflags, buildOpts.cxxflags, buildOpts.fcflags, buildOpts.fflags, buildOpts.ldflags, buildOpts.asflags]
+
+        data = {
+            "arch": self.arch,
+            "profile": self.profile,
+            "build_opts": __flags(self.build_opts),
+            "pkg_build_opts": {k: __flags(v) for k, v in self.pkg_build_opts.items()},
+            "pkg_use": self.pkg_use,
+            "pkg_use_files": self.pkg_use_files,
+            "use_mask": self.use_mask,
+        }
+        digest = hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+        return "%s-%s" % (self.arch, digest[:16])
+
 
 class TargetSettingsBuildOpts:
 
@@ -273,6 +417,8 @@ class TargetSettingsBuildOpts:
         self.ldflags = []
         self.asflags = []
 
+        self.jobs = None                # number of make jobs, determined by host computing power if None
+
         self.ccache = None
 
     @classmethod
@@ -327,6 +473,12 @@ class TargetSettingsBuildOpts:
             else:
                 return False
 
+        if obj.jobs is not None and (not isinstance(obj.jobs, int) or obj.jobs <= 0):
+            if raise_exception:
+                raise SettingsError("invalid value for \"jobs\" of %s" % (obj.name))
+            else:
+                return False
+
         if obj.ccache is not None and not isinstance(obj.ccache, bool):
             if raise_exception:
                 raise SettingsError("invalid value for \"ccache\" of %s" % (obj.name))
@@ -368,7 +520,7 @@ class ComputingPower:
             # little less than the real size because various sort of
             # reservation, so we do a "+1GB"
             m = re.search("^MemTotal:\\s+(\\d+)", f.read())
-            ret.memory_size = (int(m.group(1)) // 1024 // 1024 + 1) * 1024 * 1024
+            ret.memory_size = (int(m.group(1)) // 1024 // 1024 + 1) * 1024 * 1024 * 1024
 
         # cooling_level
         ret.cooling_level = 5
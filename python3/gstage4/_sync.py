@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import time
+import contextvars
+import concurrent.futures
+from ._errors import SyncError
+from ._accounting import ResourceAccounting
+
+
+class RepositorySyncer:
+    """
+    Synchronizes independent repositories concurrently in a bounded thread pool.
+    A failure in one repository does not interrupt the others, failures are raised together after all tasks complete.
+    """
+
+    def __init__(self, max_jobs, quiet=False):
+        assert max_jobs > 0
+
+        self._maxJobs = max_jobs
+        self._quiet = quiet
+        self._taskList = []
+
+    def add_task(self, repo_name, func, *kargs):
+        assert repo_name not in [x[0] for x in self._taskList]
+        self._taskList.append((repo_name, func, kargs))
+
+    def run(self):
+        # returns dict<repo-name, (elapsed-seconds, exception-or-None)>
+        ret = dict()
+        if len(self._taskList) == 0:
+            return ret
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self._maxJobs, len(self._taskList))) as executor:
+            futureDict = dict()
+            for repoName, func, kargs in self._taskList:
+                # tasks inherit the context of the caller, so that their commands are accounted to it
+                ctx = contextvars.copy_context()
+                futureDict[executor.submit(ctx.run, self._runTask, repoName, func, kargs)] = repoName
+
+            for f in concurrent.futures.as_completed(futureDict):
+                repoName = futureDict[f]
+                elapsed, e = f.result()
+                ret[repoName] = (elapsed, e)
+                if not self._quiet:
+                    if e is None:
+                        print("Sync repository %s finished (%.1fs)" % (repoName, elapsed))
+                    else:
+                        print("Sync repository %s failed (%.1fs): %s" % (repoName, elapsed, e))
+
+        failedList = sorted([k for k, v in ret.items() if v[1] is not None])
+        if len(failedList) > 0:
+            raise SyncError("failed to sync repositories: %s" % (", ".join(failedList)), ret)
+
+        return ret
+
+    def _runTask(self, repoName, func, kargs):
+        if not self._quiet:
+            print("Sync repository %s" % (repoName))
+        tm = time.monotonic()
+        try:
+            with ResourceAccounting.describe("Sync repository %s" % (repoName)):
+                func(*kargs)
+            return (time.monotonic() - tm, None)
+        except Exception as e:
+            return (time.monotonic() - tm, e)
@@ -23,10 +23,22 @@
 
 import os
 import re
+import lzma
+import gzip
 import time
+import errno
+import fcntl
+import ctypes
+import queue
 import pickle
 import tempfile
+import threading
+import contextvars
 import subprocess
+import collections
+import concurrent.futures
+from ._mounttable import MountTable
+from ._accounting import CommandTimer
 
 
 class Util:
@@ -61,16 +73,26 @@ class Util:
     @staticmethod
     def isMount(path):
         """Like os.path.ismount, but also support bind mounts"""
-        if os.path.ismount(path):
-            return 1
-        a = os.popen("mount")
-        mylines = a.readlines()
-        a.close()
-        for line in mylines:
-            mysplit = line.split()
-            if Util.pathCompare(path, mysplit[2]):
-                return 1
-        return 0
+        return MountTable.get_thread_instance().is_mount(path)
+
+    @staticmethod
+    def mount(source, target, fstype=None, flags=0, data=None):
+        # calls mount(2) directly, no process is spawned
+        def __c(s):
+            return s.encode("utf-8") if s is not None else None
+
+        libc = _getLibc()
+        if libc.mount(__c(source), __c(target), __c(fstype), flags, __c(data)) != 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "mount \"%s\" failed, %s" % (target, os.strerror(e)))
+
+    @staticmethod
+    def umount(target, flags=0):
+        # calls umount2(2) directly, no process is spawned
+        libc = _getLibc()
+        if libc.umount2(target.encode("utf-8"), flags) != 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "umount \"%s\" failed, %s" % (target, os.strerror(e)))
 
     @staticmethod
     def isInstanceList(obj, *instances):
@@ -80,7 +102,7 @@ class Util:
         return False
 
     @staticmethod
-    def cmdCall(cmd, *kargs):
+    def cmdCall(cmd, *kargs, capture=True, log_file=None, line_callback=None):
         # call command to execute backstage job
         #
         # scenario 1, process group receives SIGTERM, SIGINT and SIGHUP:
@@ -91,47 +113,56 @@ class Util:
         #   * callee must auto-terminate, and cause no side-effect, after caller is terminated
         # scenario 3, callee receives SIGTERM, SIGINT, SIGHUP:
         #   * caller detects child-process failure and do appopriate treatment
+        #
+        # output is streamed, see OutputCapture for capture, log_file and line_callback
 
-        ret = subprocess.run([cmd] + list(kargs),
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             universal_newlines=True)
+        ret = OutputCapture(capture, log_file, line_callback).run([cmd] + list(kargs), False)
         if ret.returncode > 128:
             # for scenario 1, caller's signal handler has the oppotunity to get executed during sleep
             time.sleep(1.0)
         if ret.returncode != 0:
             print(ret.stdout)
             ret.check_returncode()
-        return ret.stdout.rstrip()
+        return ret.stdout.rstrip() if capture else None
+
+    @staticmethod
+    def cmdCallTestSuccess(cmd, *kargs):
+        ret = OutputCapture(capture=False).run([cmd] + list(kargs), False)
+        if ret.returncode > 128:
+            time.sleep(1.0)
+        return (ret.returncode == 0)
 
     @staticmethod
-    def shellCall(cmd):
+    def shellCall(cmd, capture=True, log_file=None, line_callback=None, preexec_fn=None):
         # call command with shell to execute backstage job
         # scenarios are the same as FmUtil.cmdCall
 
-        ret = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             shell=True, universal_newlines=True)
+        ret = OutputCapture(capture, log_file, line_callback, preexec_fn).run(cmd, True)
         if ret.returncode > 128:
             # for scenario 1, caller's signal handler has the oppotunity to get executed during sleep
             time.sleep(1.0)
         if ret.returncode != 0:
             print(ret.stdout)
             ret.check_returncode()
-        return ret.stdout.rstrip()
+        return ret.stdout.rstrip() if capture else None
 
     @staticmethod
-    def shellCallTestSuccess(cmd):
-        ret = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             shell=True, universal_newlines=True)
+    def shellCallTestSuccess(cmd, preexec_fn=None):
+        ret = OutputCapture(capture=False, preexec_fn=preexec_fn).run(cmd, True)
         if ret.returncode > 128:
             time.sleep(1.0)
         return (ret.returncode == 0)
 
     @staticmethod
-    def shellExec(cmd):
-        ret = subprocess.run(cmd, shell=True, universal_newlines=True)
-        if ret.returncode > 128:
+    def shellExec(cmd, preexec_fn=None):
+        timer = CommandTimer(cmd)
+        with subprocess.Popen(cmd, shell=True, universal_newlines=True, preexec_fn=preexec_fn) as proc:
+            rusage = _waitProcess(proc)
+        timer.finish(proc.returncode, rusage)
+        if proc.returncode > 128:
             time.sleep(1.0)
-        ret.check_returncode()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
 
     @staticmethod
     def portageIsPkgInstalled(rootDir, pkg):
@@ -143,6 +174,97 @@ class Util:
         return False
 
 
+class OutputCapture:
+
+    """
+    Runs a command and reads its output incrementally.
+    Each line is passed to line_callback and written to log_file (compressed if it ends with ".gz" or ".xz").
+    The whole output is kept in memory only if capture is True, otherwise only the last lines are kept for error reporting.
+    """
+
+    TAIL_LINES = 200
+
+    def __init__(self, capture=True, log_file=None, line_callback=None, preexec_fn=None):
+        self._capture = capture
+        self._logFile = log_file
+        self._callback = line_callback
+        self._preexecFn = preexec_fn
+
+    def run(self, args, shell):
+        # returns subprocess.CompletedProcess, its stdout is the whole output or the tail
+        if self._logFile is None:
+            logf = None
+        elif self._logFile.endswith(".gz"):
+            logf = gzip.open(self._logFile, "at")
+        elif self._logFile.endswith(".xz"):
+            logf = lzma.open(self._logFile, "at")
+        else:
+            logf = open(self._logFile, "a")
+
+        try:
+            lines = [] if self._capture else collections.deque(maxlen=self.TAIL_LINES)
+            omitted = 0
+            timer = CommandTimer(args)
+            with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=shell,
+                                  universal_newlines=True, errors="replace", preexec_fn=self._preexecFn) as proc:
+                for line in proc.stdout:
+                    if self._callback is not None:
+                        self._callback(line)
+                    if logf is not None:
+                        logf.write(line)
+                    if not self._capture and len(lines) == lines.maxlen:
+                        omitted += 1
+                    lines.append(line)
+                rusage = _waitProcess(proc)
+            timer.finish(proc.returncode, rusage)
+
+            out = "".join(lines)
+            if omitted > 0:
+                out = "(%d lines omitted)\n" % (omitted) + out
+            return subprocess.CompletedProcess(args, proc.returncode, out)
+        finally:
+            if logf is not None:
+                logf.close()
+
+
+MS_RDONLY = 1                   # <sys/mount.h>
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_REMOUNT = 32
+MS_BIND = 4096
+MS_REC = 16384
+MS_PRIVATE = 1 << 18
+MS_SLAVE = 1 << 19
+
+MNT_DETACH = 2                  # <sys/mount.h>
+
+_libc = None
+
+
+def _waitProcess(proc):
+    # same as proc.wait(), but also returns resource usage of the process and its waited descendants
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+def _getLibc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL("libc.so.6", use_errno=True)
+        libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+        libc.mount.restype = ctypes.c_int
+        libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        libc.umount2.restype = ctypes.c_int
+        libc.unshare.argtypes = [ctypes.c_int]
+        libc.unshare.restype = ctypes.c_int
+        libc.setns.argtypes = [ctypes.c_int, ctypes.c_int]
+        libc.setns.restype = ctypes.c_int
+        _libc = libc
+    return _libc
+
+
 class TempChdir:
 
     def __init__(self, dirname):
@@ -156,6 +278,48 @@ class TempChdir:
         os.chdir(self.olddir)
 
 
+class FileLock:
+
+    """
+    Inter-process lock based on flock(), used to protect host side caches shared by concurrent builds.
+    The lock file may be deleted by its exclusive holder, lockers retry if the file is deleted or replaced while they
+    are waiting for the lock.
+    BlockingIOError is raised by __enter__() if blocking is False and the lock is held by others.
+    """
+
+    def __init__(self, path, shared=False, blocking=True):
+        self._path = path
+        self._shared = shared
+        self._blocking = blocking
+        self._f = None
+
+    def __enter__(self):
+        flags = fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX
+        if not self._blocking:
+            flags |= fcntl.LOCK_NB
+
+        while True:
+            f = open(self._path, "a")
+            try:
+                fcntl.flock(f, flags)
+                try:
+                    st = os.stat(self._path)
+                except FileNotFoundError:
+                    st = None
+                if st is not None and st.st_ino == os.fstat(f.fileno()).st_ino and st.st_dev == os.fstat(f.fileno()).st_dev:
+                    self._f = f
+                    return self
+            except BaseException:
+                f.close()
+                raise
+            f.close()
+
+    def __exit__(self, type, value, traceback):
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
+
+
 class TmpMount:
 
     def __init__(self, path, options=None):
@@ -189,60 +353,97 @@ class TmpMount:
         os.rmdir(self._tmppath)
 
 
-# class NewMountNamespace:
+class NewMountNamespace:
 
-#     _CLONE_NEWNS = 0x00020000               # <linux/sched.h>
-#     _MS_REC = 16384                         # <sys/mount.h>
-#     _MS_PRIVATE = 1 << 18                   # <sys/mount.h>
-#     _libc = None
-#     _mount = None
-#     _setns = None
-#     _unshare = None
+    """
+    A new private mount namespace, which is held by a dedicated thread, so that the calling thread never leaves its own
+    namespace and keeps sharing cwd and umask with the other threads.
+    Mounts are done in the namespace by call(), processes are moved into it by using enter_in_child() as preexec_fn.
+    Mounts made in the namespace are invisible to the host, they should be unmounted before close(), since a leftover
+    process in the namespace would keep them alive.
+    """
 
-#     def __init__(self):
-#         if self._libc is None:
-#             self._libc = ctypes.CDLL('libc.so.6', use_errno=True)
-#             self._mount = self._libc.mount
-#             self._mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
-#             self._mount.restype = ctypes.c_int
-#             self._setns = self._libc.setns
-#             self._unshare = self._libc.unshare
+    _CLONE_NEWNS = 0x00020000               # <linux/sched.h>
 
-#         self.parentfd = None
+    def __init__(self):
+        self.fd = None
+        self._thread = None
+        self._queue = None
 
-#     def open(self):
-#         assert self.parentfd is None
+    def open(self):
+        assert self._thread is None
 
-#         self.parentfd = open("/proc/%d/ns/mnt" % (os.getpid()), 'r')
+        ready = concurrent.futures.Future()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, args=(ready,), daemon=True)
+        self._thread.start()
+        try:
+            self.fd = ready.result()
+        except BaseException:
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+            raise
 
-#         # copied from unshare.c of util-linux
-#         try:
-#             if self._unshare(self._CLONE_NEWNS) != 0:
-#                 e = ctypes.get_errno()
-#                 raise OSError(e, errno.errorcode[e])
-
-#             srcdir = ctypes.c_char_p("none".encode("utf_8"))
-#             target = ctypes.c_char_p("/".encode("utf_8"))
-#             if self._mount(srcdir, target, None, (self._MS_REC | self._MS_PRIVATE), None) != 0:
-#                 e = ctypes.get_errno()
-#                 raise OSError(e, errno.errorcode[e])
-#         except BaseException:
-#             self.parentfd.close()
-#             self.parentfd = None
-#             raise
+    def close(self):
+        # the namespace is destroyed by kernel when the thread exits, unless there are processes still in it
+        assert self._thread is not None
+
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._queue = None
+        self.fd.close()
+        self.fd = None
+
+    def call(self, func, *args):
+        # runs func in the namespace thread with context of the calling thread, returns its result or raises its exception
+        assert self._thread is not None
+
+        if threading.current_thread() is self._thread:
+            return func(*args)
+        f = concurrent.futures.Future()
+        self._queue.put((contextvars.copy_context(), func, args, f))
+        return f.result()
+
+    def enter_in_child(self):
+        # used as preexec_fn of subprocess, the child process is single-threaded so that setns() always succeeds
+        if _getLibc().setns(self.fd.fileno(), self._CLONE_NEWNS) != 0:
+            e = ctypes.get_errno()
+            raise OSError(e, errno.errorcode[e])
 
-#     def close(self):
-#         assert self.parentfd is not None
+    def __enter__(self):
+        self.open()
+        return self
 
-#         self._setns(self.parentfd.fileno(), 0)
-#         self.parentfd.close()
-#         self.parentfd = None
+    def __exit__(self, *_):
+        self.close()
 
-#     def __enter__(self):
-#         return self
+    def _run(self, ready):
+        # this thread never returns to the parent namespace, it simply exits, so there's no error path to restore
+        try:
+            # copied from unshare.c of util-linux
+            libc = _getLibc()
+            if libc.unshare(self._CLONE_NEWNS) != 0:
+                e = ctypes.get_errno()
+                raise OSError(e, errno.errorcode[e])
+            Util.mount("none", "/", None, MS_REC | MS_PRIVATE)
+            fd = open("/proc/thread-self/ns/mnt", "r")
+        except BaseException as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(fd)
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            ctx, func, args, f = item
+            try:
+                f.set_result(ctx.run(func, *args))
+            except BaseException as e:
+                f.set_exception(e)
 
-#     def __exit__(self, *_):
-#         self.close()
 
 # class FakeChroot:
 
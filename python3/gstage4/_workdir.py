@@ -155,6 +155,9 @@ class WorkDir:
         if to_dir_name is not None:
             assert not to_dir_name.endswith(".save")
             assert to_dir_name != self._CURRENT and to_dir_name not in self.get_old_chroot_dir_names()
+            if os.path.isfile(os.path.join(self._path, to_dir_name)):
+                # closing to the directory it was opened from, remove the placeholder created by open_chroot_dir()
+                os.unlink(os.path.join(self._path, to_dir_name))
             robust_layer.simple_fops.mv(curPath, os.path.join(self._path, to_dir_name))
         else:
             robust_layer.simple_fops.rm(curPath)
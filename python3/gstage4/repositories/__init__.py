@@ -22,6 +22,8 @@
 
 
 from ._gentoo import CloudGentoo
+from ._gentoo import CloudGentooWithHostMirror
+from ._gentoo import CloudGentooGitWithHostMirror
 from ._gentoo import CloudGentooSnapshot
 from ._gentoo import GentooSnapshot
 from ._gentoo import GentooSnapshotAsSquashfs
@@ -22,13 +22,24 @@
 
 
 import os
+import re
+import lzma
+import shutil
+import hashlib
+import pathlib
 import tarfile
+import tempfile
+import contextlib
+import subprocess
 import urllib.request
+import robust_layer.simple_fops
 from .. import ManualSyncRepository
 from .. import EmergeSyncRepository
 from .. import MountRepository
 from .._util import Util
 from .._util import TmpMount
+from .._util import FileLock
+from .._errors import RepositoryError
 
 
 class CloudGentoo(EmergeSyncRepository):
@@ -65,14 +76,179 @@ class CloudGentoo(EmergeSyncRepository):
         return buf
 
 
+class CloudGentooWithHostMirror(ManualSyncRepository):
+
+    """
+    Gentoo repository cloned from a persistent host side mirror, the mirror is updated incrementally by rsync.
+    The mirror is verified by gemato against the signed Manifest after every update, like portage does with
+    "sync-rsync-verify-metamanifest = yes".
+    """
+
+    _MAX_RETRIES = 3
+
+    def __init__(self, mirror_dir, url="rsync://mirrors.tuna.tsinghua.edu.cn/gentoo-portage", openpgp_key_path="/usr/share/openpgp-keys/gentoo-release.asc"):
+        self._mirrorDir = mirror_dir
+        self._url = url
+        self._keyPath = openpgp_key_path
+
+    @property
+    def mirror_dir(self):
+        return self._mirrorDir
+
+    def get_name(self):
+        return _NAME
+
+    def get_datadir_path(self):
+        return _DATADIR_PATH
+
+    def update_mirror(self):
+        os.makedirs(self._mirrorDir, exist_ok=True)
+        with FileLock(self._getLockFile()):
+            self._updateMirror()
+            self._verifyMirror()
+
+    def sync(self, datadir_hostpath):
+        # mirror is locked exclusively only for updating, copies of concurrent builds share the lock
+        # another build may leave the mirror unverified between the two locks, update again in this case
+        for i in range(0, self._MAX_RETRIES):
+            self.update_mirror()
+            with FileLock(self._getLockFile(), shared=True):
+                if os.path.exists(self._getVerifiedFlagFile()):
+                    # clone mirror into chroot, it is instantaneous if the filesystem supports reflink
+                    Util.cmdCall("cp", "-a", "--reflink=auto", os.path.join(self._mirrorDir, "."), datadir_hostpath)
+                    return
+        raise RepositoryError("gentoo repository mirror \"%s\" can not be verified" % (self._mirrorDir))
+
+    def _updateMirror(self):
+        robust_layer.simple_fops.rm(self._getVerifiedFlagFile())
+
+        # same options as portage's rsync sync module, except that "--whole-file" is not used so that only deltas are transfered
+        Util.cmdCall("rsync",
+                     "--recursive", "--links", "--safe-links", "--perms", "--times", "--omit-dir-times",
+                     "--compress", "--force", "--delete", "--timeout=180",
+                     "--exclude=/distfiles", "--exclude=/local", "--exclude=/packages", "--exclude=/.git",
+                     self._url.rstrip("/") + "/", self._mirrorDir)
+
+    def _verifyMirror(self):
+        # the mirror is left as is if verification fails, it is fixed by the next update
+        try:
+            Util.cmdCall("gemato", "verify", "--require-signed-manifest", "--openpgp-key", self._keyPath, self._mirrorDir)
+        except subprocess.CalledProcessError:
+            raise RepositoryError("verification failed for gentoo repository mirror \"%s\"" % (self._mirrorDir))
+        with open(self._getVerifiedFlagFile(), "w"):
+            pass
+
+    def _getLockFile(self):
+        # lock file can not be put in mirror directory, rsync would delete it
+        return self._mirrorDir.rstrip("/") + ".lock"
+
+    def _getVerifiedFlagFile(self):
+        # exists only when the mirror is not changed since the last successful verification
+        return self._mirrorDir.rstrip("/") + ".verified"
+
+
+class CloudGentooGitWithHostMirror(ManualSyncRepository):
+
+    """Gentoo repository checked out from a host side shallow bare clone of the gentoo git mirror"""
+
+    _MAX_RETRIES = 3
+
+    def __init__(self, mirror_dir, revision=None, depth=1, url="https://github.com/gentoo-mirror/gentoo.git", branch="stable"):
+        assert depth > 0
+        assert revision is None or re.fullmatch(r"[0-9a-fA-F]{4,39}", revision) is None      # remote can't resolve abbreviated commit id, use the full one
+
+        self._mirrorDir = mirror_dir
+        self._revision = revision          # None means the latest revision of branch
+        self._depth = depth
+        self._url = url
+        self._branch = branch
+
+        self._syncedRevision = None
+
+    @property
+    def mirror_dir(self):
+        return self._mirrorDir
+
+    @property
+    def revision(self):
+        # the revision that is checked out by the last sync() call, it can be used to reproduce the build
+        return self._syncedRevision
+
+    def get_name(self):
+        return _NAME
+
+    def get_datadir_path(self):
+        return _DATADIR_PATH
+
+    def sync(self, datadir_hostpath):
+        os.makedirs(os.path.dirname(self._mirrorDir.rstrip("/")), exist_ok=True)
+
+        # mirror is locked exclusively only for fetching, exports of concurrent builds share the lock
+        # the revision may be pruned by a fetch between the two locks, fetch again in this case
+        for i in range(0, self._MAX_RETRIES):
+            with FileLock(self._getLockFile()):
+                rev = self._fetch()
+            with FileLock(self._getLockFile(), shared=True):
+                if self._hasCommit(rev):
+                    self._export(rev, datadir_hostpath)
+                    self._syncedRevision = rev
+                    return
+        raise RepositoryError("revision %s disappeared from gentoo repository mirror \"%s\"" % (rev, self._mirrorDir))
+
+    def _fetch(self):
+        # returns the commit id to be checked out
+        if not os.path.exists(self._mirrorDir):
+            Util.cmdCall("git", "init", "-q", "--bare", self._mirrorDir)
+
+        if self._revision is None:
+            # only fetch the commits that we don't have, history deeper than depth is not fetched
+            self._gitCall("fetch", "-q", "--depth=%d" % (self._depth), self._url, "+refs/heads/%s:refs/heads/%s" % (self._branch, self._branch))
+            return self._gitCall("rev-parse", "refs/heads/%s" % (self._branch))
+        else:
+            # no network access is needed if the pinned revision is already in mirror
+            if self._hasCommit(self._revision):
+                return self._gitCall("rev-parse", "%s^{commit}" % (self._revision))
+            self._gitCall("fetch", "-q", "--depth=%d" % (self._depth), self._url, self._revision)
+            return self._gitCall("rev-parse", "FETCH_HEAD^{commit}")
+
+    def _export(self, rev, datadir_hostpath):
+        # export the tree into chroot, there's no .git in the result so no dependency on the host side clone
+        p1 = subprocess.Popen(["git", "--git-dir=%s" % (self._mirrorDir), "archive", "--format=tar", rev], stdout=subprocess.PIPE)
+        p2 = subprocess.Popen(["tar", "-x", "-C", datadir_hostpath], stdin=p1.stdout)
+        p1.stdout.close()
+        p2.communicate()
+        p1.wait()
+        if p1.returncode != 0:
+            raise subprocess.CalledProcessError(p1.returncode, p1.args)
+        if p2.returncode != 0:
+            raise subprocess.CalledProcessError(p2.returncode, p2.args)
+
+    def _hasCommit(self, rev):
+        return Util.cmdCallTestSuccess("git", "--git-dir=%s" % (self._mirrorDir), "cat-file", "-e", "%s^{commit}" % (rev))
+
+    def _gitCall(self, *kargs):
+        return Util.cmdCall("git", "--git-dir=%s" % (self._mirrorDir), *kargs)
+
+    def _getLockFile(self):
+        return self._mirrorDir.rstrip("/") + ".lock"
+
+
 class CloudGentooSnapshot(ManualSyncRepository):
 
-    def __init__(self, date=None):
+    def __init__(self, date=None, store_dir=None, store_max_count=8):
+        assert store_max_count > 0
+
         if date is not None:
             self._date = date.strftime("%Y%m%d")
         else:
             self._date = "latest"
 
+        # dated snapshots never change, so they are downloaded and verified only once and shared by all the builds
+        if store_dir is not None and date is not None:
+            self._store = _SnapshotStore(store_dir, store_max_count)
+        else:
+            self._store = None
+
     def get_name(self):
         return _NAME
 
@@ -80,11 +256,30 @@ class CloudGentooSnapshot(ManualSyncRepository):
         return _DATADIR_PATH
 
     def sync(self, datadir_hostpath):
-        url = "rsync://mirrors.tuna.tsinghua.edu.cn/gentoo-portage"
-        url = os.path.join(url, "snapshots", "gentoo-%s.tar.xz" % (self._date))
-        with urllib.request.urlopen(url) as resp:
-            with tarfile.open(fileobj=resp, mode="r:xz") as tf:
-                tf.extractall(datadir_hostpath)
+        fn = "gentoo-%s.tar.xz" % (self._date)
+        url = os.path.join("https://mirrors.tuna.tsinghua.edu.cn/gentoo", "snapshots", fn)
+
+        def __download(filepath):
+            with urllib.request.urlopen(url) as resp:
+                with open(filepath, "wb") as f:
+                    shutil.copyfileobj(resp, f)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                digestFilepath = os.path.join(tmpdir, fn + ".md5sum")
+                with urllib.request.urlopen(url + ".md5sum") as resp:
+                    with open(digestFilepath, "wb") as f:
+                        f.write(resp.read())
+                _verifyDigest(filepath, digestFilepath)
+
+        if self._store is not None:
+            with self._store.use(fn, __download) as filepath:
+                with tarfile.open(filepath, mode="r:xz") as tf:
+                    tf.extractall(datadir_hostpath)
+        else:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                filepath = os.path.join(tmpdir, fn)
+                __download(filepath)
+                with tarfile.open(filepath, mode="r:xz") as tf:
+                    tf.extractall(datadir_hostpath)
 
 
 class GentooSnapshot(ManualSyncRepository):
@@ -93,6 +288,7 @@ class GentooSnapshot(ManualSyncRepository):
         assert any([filepath.endswith(x) for x in [".tar.xz", ".lzo.sqfs", ".xz.sqfs"]])
         if digest_filepath is not None:
             assert any([digest_filepath == filepath + x for x in [".gpgsig", ".md5sum", ".umd5sum"]])
+            assert not digest_filepath.endswith(".umd5sum") or filepath.endswith(".tar.xz")       # digest of the uncompressed content is only provided for xz tarball
 
         self._path = filepath
         self._hashPath = digest_filepath
@@ -104,6 +300,9 @@ class GentooSnapshot(ManualSyncRepository):
         return _DATADIR_PATH
 
     def sync(self, datadir_hostpath):
+        if self._hashPath is not None:
+            _verifyDigest(self._path, self._hashPath)
+
         if self._path.endswith(".tar.xz"):
             with tarfile.open(self._path, mode="r:xz") as tf:
                 tf.extractall(datadir_hostpath)
@@ -145,6 +344,93 @@ class GentooFromHost(MountRepository):
         return (self._hostDir, "bind")
 
 
+class _SnapshotStore:
+
+    """
+    Host side store of verified snapshot files, shared by concurrent builds.
+    A snapshot file is locked exclusively when being downloaded, and shared when being used.
+    Least recently used snapshot files are evicted when there're more than max_count files, files in use are never evicted.
+    """
+
+    def __init__(self, store_dir, max_count):
+        self._dir = store_dir
+        self._maxCount = max_count
+
+    _MAX_RETRIES = 3
+
+    @contextlib.contextmanager
+    def use(self, file_name, download_func):
+        os.makedirs(self._dir, exist_ok=True)
+        filepath = os.path.join(self._dir, file_name)
+
+        # the file may be evicted by other builds between the two locks, download it again in this case
+        for i in range(0, self._MAX_RETRIES):
+            with FileLock(filepath + ".lock"):
+                # only verified file is renamed to its final name
+                if not os.path.exists(filepath):
+                    try:
+                        download_func(filepath + ".tmp")
+                        os.rename(filepath + ".tmp", filepath)
+                    finally:
+                        robust_layer.simple_fops.rm(filepath + ".tmp")
+
+                # modification time is used as last access time
+                os.utime(filepath)
+
+            # allow other builds to use this file concurrently
+            with FileLock(filepath + ".lock", shared=True):
+                if os.path.exists(filepath):
+                    self._evict()
+                    yield filepath
+                    return
+
+        raise RepositoryError("snapshot \"%s\" is evicted repeatedly" % (filepath))
+
+    def _evict(self):
+        fileList = []
+        for fn in os.listdir(self._dir):
+            fullfn = os.path.join(self._dir, fn)
+            if not fn.endswith(".lock") and not fn.endswith(".tmp") and os.path.isfile(fullfn):
+                fileList.append((os.path.getmtime(fullfn), fullfn))
+        fileList.sort()
+
+        count = len(fileList)
+        for mtime, fullfn in fileList:
+            if count <= self._maxCount:
+                break
+            try:
+                with FileLock(fullfn + ".lock", blocking=False):
+                    if os.path.exists(fullfn):
+                        os.unlink(fullfn)
+                        count -= 1
+                    # waiters of the lock retry on the new lock file, see FileLock
+                    os.unlink(fullfn + ".lock")
+            except BlockingIOError:
+                # in use by another build
+                pass
+
+
+def _verifyDigest(filepath, digestFilepath):
+    if digestFilepath.endswith(".gpgsig"):
+        if not Util.cmdCallTestSuccess("gpg", "--verify", digestFilepath, filepath):
+            raise RepositoryError("invalid signature for \"%s\"" % (filepath))
+    elif digestFilepath.endswith(".md5sum") or digestFilepath.endswith(".umd5sum"):
+        expected = pathlib.Path(digestFilepath).read_text().split()[0].lower()
+        h = hashlib.md5()
+        if digestFilepath.endswith(".umd5sum"):
+            # digest of the uncompressed content
+            f = lzma.open(filepath, "rb")
+        else:
+            f = open(filepath, "rb")
+        with f:
+            for buf in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(buf)
+        if h.hexdigest() != expected:
+            raise RepositoryError("digest verification failed for \"%s\"" % (filepath))
+    else:
+        assert False
+
+
 _NAME = "gentoo"
 
 _DATADIR_PATH = "/var/db/repos/gentoo"
@@ -21,8 +21,17 @@
 # THE SOFTWARE.
 
 
+import os
+import json
+import time
+import threading
+import urllib.error
+import urllib.request
+import xml.etree.ElementTree
 from .. import MountRepository
 from .. import EmergeSyncRepository
+from .._util import FileLock
+from .._errors import RepositoryError
 
 
 class OverlayFromHost(MountRepository):
@@ -60,15 +69,9 @@ class RegisteredOverlay(EmergeSyncRepository):
 
     """Overlay in Gentoo Overlay Database (https://api.gentoo.org/overlays/repositories.xml)"""
 
-    def __init__(self, overlay_name):
+    def __init__(self, overlay_name, cache_dir="/var/cache/gstage4"):
         self._name = overlay_name
-
-        # FIXME:
-        # 1. retrieve repositories.xml
-        # 2. get info by overlay_name
-        self._syncType = None
-        self._syncUrl = None
-        assert False
+        self._syncType, self._syncUrl = _OverlayDatabase.get_instance(cache_dir).lookup(overlay_name)
 
     def get_name(self):
         return self._name
@@ -115,3 +118,120 @@ class UserDefinedOverlay(EmergeSyncRepository):
         buf += "sync-type = %s\n" % (self._syncType)
         buf += "sync-uri = %s\n" % (self._syncUrl)
         return buf
+
+
+class _OverlayDatabase:
+
+    """
+    Local index of the Gentoo Overlay Database.
+    repositories.xml is parsed only once into a name -> (sync-type, sync-url) index, which is stored in cache directory.
+    The index is refreshed by conditional HTTP request, so an unchanged repositories.xml is never downloaded again.
+    """
+
+    _URL = "https://api.gentoo.org/overlays/repositories.xml"
+
+    _INDEX_FILE_NAME = "overlays.json"
+
+    _REFRESH_INTERVAL = 3600                  # in seconds
+
+    _RETRY_INTERVAL = 300                     # in seconds, when the refresh failed and the stale index is used
+
+    _SOURCE_PREFERENCE = [
+        ("git", "https://"),
+        ("git", "git://"),
+        ("git", "http://"),
+        ("rsync", "rsync://"),
+    ]
+
+    _instances = dict()
+
+    _instancesLock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls, cache_dir):
+        with cls._instancesLock:
+            if cache_dir not in cls._instances:
+                cls._instances[cache_dir] = cls(cache_dir)
+            return cls._instances[cache_dir]
+
+    def __init__(self, cache_dir):
+        self._cacheDir = cache_dir
+        self._lock = threading.Lock()
+        self._data = None           # loaded lazily
+
+    def lookup(self, overlay_name):
+        with self._lock:
+            if self._data is None or time.time() - self._data["checked"] >= self._REFRESH_INTERVAL:
+                self._load()
+            if overlay_name not in self._data["repos"]:
+                raise RepositoryError("overlay \"%s\" not found in overlay database" % (overlay_name))
+            return tuple(self._data["repos"][overlay_name])
+
+    def _load(self):
+        os.makedirs(self._cacheDir, exist_ok=True)
+        indexFile = os.path.join(self._cacheDir, self._INDEX_FILE_NAME)
+
+        with FileLock(indexFile + ".lock"):
+            data = None
+            if os.path.exists(indexFile):
+                with open(indexFile, "r") as f:
+                    data = json.load(f)
+
+            if data is None or time.time() - data["checked"] >= self._REFRESH_INTERVAL:
+                data = self._refresh(data)
+                with open(indexFile + ".tmp", "w") as f:
+                    json.dump(data, f, separators=(",", ":"))
+                os.rename(indexFile + ".tmp", indexFile)
+
+            self._data = data
+
+    def _refresh(self, data):
+        req = urllib.request.Request(self._URL)
+        if data is not None:
+            if data["etag"] is not None:
+                req.add_header("If-None-Match", data["etag"])
+            if data["last_modified"] is not None:
+                req.add_header("If-Modified-Since", data["last_modified"])
+
+        try:
+            with urllib.request.urlopen(req, timeout=60) as resp:
+                return {
+                    "etag": resp.headers.get("ETag"),
+                    "last_modified": resp.headers.get("Last-Modified"),
+                    "checked": time.time(),
+                    "repos": self._parse(resp),
+                }
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and data is not None:
+                data["checked"] = time.time()
+                return data
+            if data is None:
+                raise
+            return self._useStale(data, e)
+        except (OSError, xml.etree.ElementTree.ParseError) as e:
+            # URLError and timeout are OSError
+            if data is None:
+                raise
+            return self._useStale(data, e)
+
+    def _useStale(self, data, e):
+        # the cached index is still usable when the network or the server is down, refresh is retried a while later
+        print("Warning: failed to refresh overlay database (%s), use the cached one" % (e))
+        data["checked"] = max(data["checked"], time.time() - self._REFRESH_INTERVAL + self._RETRY_INTERVAL)
+        return data
+
+    def _parse(self, fileobj):
+        # parse incrementally and discard each element after use, so that the whole XML tree is never held in memory
+        ret = dict()
+        for event, elem in xml.etree.ElementTree.iterparse(fileobj):
+            if elem.tag != "repo":
+                continue
+            name = elem.findtext("name")
+            sourceList = [(x.get("type"), x.text.strip()) for x in elem.findall("source") if x.text is not None]
+            for syncType, prefix in self._SOURCE_PREFERENCE:
+                r = [url for t, url in sourceList if t == syncType and url.startswith(prefix)]
+                if len(r) > 0:
+                    ret[name] = (syncType, r[0])
+                    break
+            elem.clear()
+        return ret